@@ -0,0 +1,245 @@
+"""Local stand-ins for the parts of Discord's and Patreon's APIs that the app calls.
+
+Point `discord.api_base` and `patreon.api_base` in the config at these to exercise the app without touching the real
+services. Both fakes can be slowed down and made to fail with a `FaultProfile`. To run them on their own:
+
+    python -m bench.fake_upstream [--port 8090] [--latency 0.05] [--error-rate 0.01] [--ratelimit-rate 0.01]
+
+Discord is then served under /discord and Patreon under /patreon.
+
+Users are identified by their OAuth code: exchanging code "123" yields tokens for Discord user 123, and the same code
+on Patreon yields a Patreon account connected to that Discord user, with an active membership of `CAMPAIGN_ID`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import random
+from collections import Counter
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+import msgspec
+from aiohttp import web
+
+
+CAMPAIGN_ID = "1000"
+
+
+class FaultProfile(msgspec.Struct):
+    """How a fake misbehaves. Rates are the chance of each request failing that way."""
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    ratelimit_rate: float = 0.0
+    retry_after: float = 0.05
+    seed: int | None = None
+
+
+def _json(data: Any, status: int = 200, headers: dict[str, str] | None = None) -> web.Response:
+    return web.Response(body=msgspec.json.encode(data), status=status, headers=headers, content_type="application/json")
+
+
+def _bearer(request: web.Request) -> str:
+    return request.headers.get("Authorization", "").removeprefix("Bearer ")
+
+
+def _make_app(profile: FaultProfile) -> web.Application:
+    rng = random.Random(profile.seed)  # noqa: S311
+
+    @web.middleware
+    async def faults(request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> Any:
+        stats: Counter[str] = request.app["stats"]
+        stats["requests"] += 1
+        if profile.latency or profile.jitter:
+            await asyncio.sleep(max(0.0, profile.latency + rng.uniform(-profile.jitter, profile.jitter)))
+
+        roll = rng.random()
+        if roll < profile.ratelimit_rate:
+            stats["429"] += 1
+            body = {"message": "You are being rate limited.", "retry_after": profile.retry_after, "global": False}
+            return _json(body, status=429, headers={"Retry-After": str(profile.retry_after)})
+        if roll < profile.ratelimit_rate + profile.error_rate:
+            stats["500"] += 1
+            return _json({"message": "Internal Server Error"}, status=500)
+        return await handler(request)
+
+    app = web.Application(middlewares=[faults])
+    app["stats"] = Counter()
+    return app
+
+
+@web.middleware
+async def _ratelimit_headers(
+    request: web.Request,
+    handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+) -> web.StreamResponse:
+    # A generous limit, so the app is measured rather than the rate limiter; use the 429 rate to exercise that.
+    response = await handler(request)
+    route = request.match_info.route
+    response.headers["X-RateLimit-Bucket"] = f"{route.method} {route.resource.canonical if route.resource else ''}"
+    response.headers["X-RateLimit-Limit"] = "1000"
+    response.headers["X-RateLimit-Remaining"] = "999"
+    response.headers["X-RateLimit-Reset-After"] = "1"
+    return response
+
+
+def make_fake_discord(profile: FaultProfile | None = None) -> web.Application:
+    app = _make_app(profile or FaultProfile())
+    app.middlewares.append(_ratelimit_headers)
+    role_connections: dict[str, Any] = {}
+    schema: list[Any] = []
+
+    async def token(request: web.Request) -> web.Response:
+        form = await request.post()
+        if form.get("grant_type") == "refresh_token":
+            user_id = str(form["refresh_token"]).removeprefix("discord-refresh:")
+        else:
+            user_id = str(form["code"])
+        return _json(
+            {
+                "access_token": f"discord:{user_id}",
+                "expires_in": 604800,
+                "refresh_token": f"discord-refresh:{user_id}",
+            },
+        )
+
+    async def me(request: web.Request) -> web.Response:
+        user_id = _bearer(request).removeprefix("discord:")
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=7)
+        body = {
+            "application": {
+                "id": "1",
+                "name": "Fake",
+                "description": "",
+                "summary": "",
+                "hook": True,
+                "bot_public": False,
+                "bot_require_code_grant": False,
+                "verify_key": "",
+                "flags": 0,
+            },
+            "scopes": ["role_connections.write", "identify"],
+            "expires": expires,
+            "user": {
+                "id": user_id,
+                "username": f"user{user_id}",
+                "avatar": "",
+                "discriminator": "0",
+                "public_flags": 0,
+            },
+        }
+        return _json(body)
+
+    async def put_role_connection(request: web.Request) -> web.Response:
+        user_id = _bearer(request).removeprefix("discord:")
+        body = msgspec.json.decode(await request.read())
+        # Discord hands metadata values back as strings.
+        body["metadata"] = {key: str(value) for key, value in body.get("metadata", {}).items()}
+        role_connections[user_id] = body
+        return _json(body)
+
+    async def get_role_connection(request: web.Request) -> web.Response:
+        user_id = _bearer(request).removeprefix("discord:")
+        return _json(role_connections.get(user_id, {"platform_name": None, "platform_username": None, "metadata": {}}))
+
+    async def put_schema(request: web.Request) -> web.Response:
+        schema[:] = msgspec.json.decode(await request.read())
+        return _json(schema)
+
+    async def get_schema(request: web.Request) -> web.Response:
+        return _json(schema)
+
+    # The application id comes from the config, which may leave it empty.
+    app.router.add_post("/oauth2/token", token)
+    app.router.add_get("/oauth2/@me", me)
+    app.router.add_put("/users/@me/applications/{app_id:[^/]*}/role-connection", put_role_connection)
+    app.router.add_get("/users/@me/applications/{app_id:[^/]*}/role-connection", get_role_connection)
+    app.router.add_put("/applications/{app_id:[^/]*}/role-connections/metadata", put_schema)
+    app.router.add_get("/applications/{app_id:[^/]*}/role-connections/metadata", get_schema)
+    return app
+
+
+def _member_resource(user_id: str) -> dict[str, Any]:
+    return {
+        "type": "member",
+        "id": f"m{user_id}",
+        "attributes": {
+            "patron_status": "active_patron",
+            "currently_entitled_amount_cents": 500 * (1 + int(user_id) % 5),
+            "pledge_relationship_start": "2023-01-01T00:00:00+00:00",
+        },
+        "relationships": {
+            "user": {"data": {"type": "user", "id": f"p{user_id}"}},
+            "campaign": {"data": {"type": "campaign", "id": CAMPAIGN_ID}},
+            "currently_entitled_tiers": {"data": [{"type": "tier", "id": "1"}]},
+        },
+    }
+
+
+def make_fake_patreon(profile: FaultProfile | None = None) -> web.Application:
+    app = _make_app(profile or FaultProfile())
+
+    async def token(request: web.Request) -> web.Response:
+        form = await request.post()
+        if form.get("grant_type") == "refresh_token":
+            user_id = str(form["refresh_token"]).removeprefix("patreon-refresh:")
+        else:
+            user_id = str(form["code"])
+        return _json(
+            {
+                "access_token": f"patreon:{user_id}",
+                "expires_in": 2678400,
+                "refresh_token": f"patreon-refresh:{user_id}",
+            },
+        )
+
+    async def identity(request: web.Request) -> web.Response:
+        user_id = _bearer(request).removeprefix("patreon:")
+        body = {
+            "data": {
+                "type": "user",
+                "id": f"p{user_id}",
+                "attributes": {"social_connections": {"discord": {"user_id": user_id}}},
+                "relationships": {"memberships": {"data": [{"type": "member", "id": f"m{user_id}"}]}},
+            },
+            "included": [_member_resource(user_id), {"type": "campaign", "id": CAMPAIGN_ID}],
+        }
+        return _json(body)
+
+    async def member(request: web.Request) -> web.Response:
+        user_id = request.match_info["member_id"].removeprefix("m")
+        return _json({"data": _member_resource(user_id), "included": []})
+
+    async def campaigns(request: web.Request) -> web.Response:
+        return _json({"data": [{"type": "campaign", "id": CAMPAIGN_ID}]})
+
+    app.router.add_post("/oauth2/token", token)
+    app.router.add_get("/oauth2/v2/identity", identity)
+    app.router.add_get("/oauth2/v2/members/{member_id}", member)
+    app.router.add_get("/oauth2/v2/campaigns", campaigns)
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random spread, in seconds, around the latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500.")
+    parser.add_argument("--ratelimit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429.")
+    args = parser.parse_args()
+
+    profile = FaultProfile(args.latency, args.jitter, args.error_rate, args.ratelimit_rate)
+    app = web.Application()
+    app.add_subapp("/discord", make_fake_discord(profile))
+    app.add_subapp("/patreon", make_fake_patreon(profile))
+    web.run_app(app, host=args.host, port=args.port)  # pyright: ignore [reportUnknownMemberType]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""Load test for the OAuth callbacks and metadata endpoints, run against local fakes of Discord and Patreon.
+
+Run from the repository root:
+
+    python -m bench.load [--requests 2000] [--concurrency 50] [--latency 0.02] [--output results.json]
+
+The app is started as a subprocess (via main.py) with a throwaway config pointing at the fakes in bench.fake_upstream,
+so it runs exactly as it would in production, just against different base URLs. Before anything is measured, every
+simulated user goes through both OAuth callbacks once so each scenario has stored tokens and links to work with.
+
+Each scenario reports requests/sec and p50/p99 latency, and the app's resident memory afterwards. Pass --output to
+also write the results as JSON, for comparing runs across releases.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import datetime
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+import msgspec
+from aiohttp import ClientError, ClientSession, web
+from yarl import URL
+
+from .fake_upstream import CAMPAIGN_ID, FaultProfile, make_fake_discord, make_fake_patreon
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+USER_ID_BASE = 100_000_000_000_000_000
+
+ADMIN_TOKEN = "bench"
+
+
+class ScenarioResult(msgspec.Struct):
+    name: str
+    requests: int
+    errors: int
+    duration: float
+    rps: float
+    p50_ms: float
+    p99_ms: float
+    rss_bytes: int | None
+
+
+class Report(msgspec.Struct):
+    timestamp: datetime.datetime
+    python: str
+    args: dict[str, Any]
+    upstream_requests: dict[str, dict[str, int]]
+    peak_rss_bytes: int | None
+    scenarios: list[ScenarioResult]
+
+
+# (method, path, query) for the nth request of a scenario, given the number of simulated users and an OAuth state.
+RequestFactory = Callable[[int, int, str], tuple[str, str, dict[str, str]]]
+
+
+def _user_id(n: int, users: int) -> str:
+    return str(USER_ID_BASE + n % users)
+
+
+SCENARIOS: dict[str, RequestFactory] = {
+    "discord-redirect": lambda n, users, state: (
+        "GET",
+        "/discord/redirect",
+        {"code": _user_id(n, users), "state": state},
+    ),
+    "patreon-redirect": lambda n, users, state: (
+        "GET",
+        "/patreon/redirect",
+        {"code": _user_id(n, users), "state": state},
+    ),
+    "update-metadata": lambda n, users, _: (
+        "POST",
+        "/update-metadata",
+        {"user_id": _user_id(n, users)},
+    ),
+    "get-metadata": lambda n, users, _: (
+        "GET",
+        "/get-metadata",
+        {"user_id": _user_id(n, users)},
+    ),
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _write_config(directory: Path, port: int, discord_url: str, patreon_url: str, args: argparse.Namespace) -> None:
+    cookie_secret = base64.b64encode(os.urandom(32)).decode()
+    config = f"""\
+cookie_secret = "{cookie_secret}"
+admin_token = "{ADMIN_TOKEN}"
+
+[discord]
+token = "bench"
+client_id = "1"
+client_secret = "bench"
+redirect_uri = "http://127.0.0.1:{port}/discord/redirect"
+api_base = "{discord_url}"
+
+[patreon]
+client_id = "bench"
+client_secret = "bench"
+creator_access_token = "bench"
+creator_refresh_token = "bench"
+redirect_uri = "http://127.0.0.1:{port}/patreon/redirect"
+api_base = "{patreon_url}"
+campaign_id = "{CAMPAIGN_ID}"
+
+[server]
+host = "127.0.0.1"
+port = {port}
+workers = {args.workers}
+
+[storage]
+backend = "{args.storage}"
+path = "{directory / 'tokens.sqlite3'}"
+
+[jobs]
+path = "{directory / 'jobs.sqlite3'}"
+
+# Every simulated user connects from 127.0.0.1, so per-IP limits would turn nearly all of them away.
+[admission]
+enabled = false
+"""
+    (directory / "config.toml").write_text(config, encoding="utf-8")
+
+
+def _process_tree_rss(pid: int) -> int | None:
+    """The resident memory of a process and its children, from /proc. None where that isn't available."""
+
+    try:
+        children = Path(f"/proc/{pid}/task/{pid}/children").read_text().split()
+        with Path(f"/proc/{pid}/statm").open() as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+
+    total = rss_pages * os.sysconf("SC_PAGE_SIZE")
+    for child in children:
+        total += _process_tree_rss(int(child)) or 0
+    return total
+
+
+async def _wait_until_up(session: ClientSession, base_url: str, server: subprocess.Popen[bytes]) -> None:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            msg = f"The app exited during startup with code {server.returncode}."
+            raise RuntimeError(msg)
+        try:
+            async with session.get(f"{base_url}/") as response:
+                if response.status == 200:
+                    return
+        except ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    msg = "The app didn't start listening within 30 seconds."
+    raise RuntimeError(msg)
+
+
+async def _wait_for_jobs(session: ClientSession, base_url: str, timeout: float = 60) -> None:
+    # Scenarios like update-metadata leave pushes queued. Let them finish so the app isn't stopped mid-request.
+    deadline = time.monotonic() + timeout
+    headers = {"Authorization": f"Bearer {ADMIN_TOKEN}"}
+    while time.monotonic() < deadline:
+        async with session.get(f"{base_url}/admin/jobs", headers=headers) as response:
+            stats = await response.json()
+        if not stats["pending"] and not stats["running"]:
+            return
+        await asyncio.sleep(0.2)
+    print(f"Gave up waiting for queued jobs after {timeout:.0f} seconds.")  # noqa: T201
+
+
+async def _start_login(session: ClientSession, base_url: str) -> tuple[str, dict[str, str]]:
+    """Get an OAuth state from /linked-role, as a browser would, with the cookie it has to be sent back with."""
+
+    async with session.get(f"{base_url}/linked-role", allow_redirects=False) as response:
+        location = URL(response.headers["Location"])
+        state = location.query["state"]
+        return state, {"Cookie": f"client_state={response.cookies['client_state'].value}"}
+
+
+async def run_scenario(
+    session: ClientSession,
+    base_url: str,
+    factory: RequestFactory,
+    *,
+    requests: int,
+    concurrency: int,
+    users: int,
+) -> tuple[list[float], int, float]:
+    """Send `requests` requests from `concurrency` workers. Returns per-request latencies, errors and duration."""
+
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(requests))
+    # One login is shared by every simulated user; the state is only checked against the cookie, not the user.
+    state, headers = await _start_login(session, base_url)
+
+    async def worker() -> None:
+        nonlocal errors
+        for n in counter:
+            method, path, query = factory(n, users, state)
+            start = time.perf_counter()
+            try:
+                async with session.request(method, f"{base_url}{path}", params=query, headers=headers) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        errors += 1
+            except ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def _percentile_ms(latencies: list[float], percentile: int) -> float:
+    if len(latencies) < 2:
+        return 1000 * latencies[0] if latencies else 0.0
+    return 1000 * statistics.quantiles(latencies, n=100, method="inclusive")[percentile - 1]
+
+
+async def run(args: argparse.Namespace) -> Report:
+    profile = FaultProfile(args.latency, args.jitter, args.error_rate, args.ratelimit_rate, seed=args.seed)
+    fakes = {"discord": make_fake_discord(profile), "patreon": make_fake_patreon(profile)}
+    runners: list[web.AppRunner] = []
+    urls: dict[str, str] = {}
+    for name, fake in fakes.items():
+        runner = web.AppRunner(fake, access_log=None)
+        await runner.setup()
+        port = _free_port()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+        urls[name] = f"http://127.0.0.1:{port}"
+
+    scenarios: list[ScenarioResult] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        port = _free_port()
+        _write_config(directory, port, urls["discord"], urls["patreon"], args)
+        base_url = f"http://127.0.0.1:{port}"
+
+        with (directory / "app.log").open("wb") as log:
+            server = subprocess.Popen(  # noqa: S603
+                [sys.executable, str(ROOT / "main.py")],
+                cwd=directory,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+            try:
+                async with ClientSession() as session:
+                    await _wait_until_up(session, base_url, server)
+
+                    # The fakes don't fail during seeding, so that every user really ends up linked.
+                    error_rate, ratelimit_rate = profile.error_rate, profile.ratelimit_rate
+                    profile.error_rate = profile.ratelimit_rate = 0.0
+                    for name in ("discord-redirect", "patreon-redirect"):
+                        _, errors, _ = await run_scenario(
+                            session,
+                            base_url,
+                            SCENARIOS[name],
+                            requests=args.users,
+                            concurrency=args.concurrency,
+                            users=args.users,
+                        )
+                        if errors:
+                            log_tail = (directory / "app.log").read_text(errors="replace")[-4000:]
+                            msg = f"{errors} of {args.users} users failed to seed via {name}. App log:\n{log_tail}"
+                            raise RuntimeError(msg)
+                    profile.error_rate, profile.ratelimit_rate = error_rate, ratelimit_rate
+
+                    for name in args.scenarios:
+                        latencies, errors, duration = await run_scenario(
+                            session,
+                            base_url,
+                            SCENARIOS[name],
+                            requests=args.requests,
+                            concurrency=args.concurrency,
+                            users=args.users,
+                        )
+                        result = ScenarioResult(
+                            name=name,
+                            requests=len(latencies),
+                            errors=errors,
+                            duration=duration,
+                            rps=len(latencies) / duration,
+                            p50_ms=_percentile_ms(latencies, 50),
+                            p99_ms=_percentile_ms(latencies, 99),
+                            rss_bytes=_process_tree_rss(server.pid),
+                        )
+                        scenarios.append(result)
+                        print(  # noqa: T201
+                            f"{name:<18} {result.rps:>9,.0f} req/s  p50 {result.p50_ms:>7.2f}ms  "
+                            f"p99 {result.p99_ms:>7.2f}ms  errors {errors}",
+                        )
+
+                    await _wait_for_jobs(session, base_url)
+            finally:
+                server.terminate()
+                server.wait()
+                for runner in runners:
+                    await runner.cleanup()
+
+    # Only covers children that have exited and been waited for, i.e. the app, which is the only child.
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return Report(
+        timestamp=datetime.datetime.now(datetime.timezone.utc),
+        python=platform.python_version(),
+        args={key: value for key, value in vars(args).items() if key != "output"},
+        upstream_requests={name: dict(fake["stats"]) for name, fake in fakes.items()},
+        # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+        peak_rss_bytes=peak_rss if sys.platform == "darwin" else peak_rss * 1024,
+        scenarios=scenarios,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="Requests sent per scenario.")
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests in flight at once.")
+    parser.add_argument("--users", type=int, default=500, help="Distinct simulated users.")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for the app.")
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="sqlite")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds the fakes take to respond.")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Random spread, in seconds, around the latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream requests that 500.")
+    parser.add_argument("--ratelimit-rate", type=float, default=0.0, help="Fraction of upstream requests that 429.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the fakes' latency and failures.")
+    parser.add_argument("--output", type=Path, default=None, help="Write the results here as JSON.")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.output is not None:
+        args.output.write_bytes(msgspec.json.format(msgspec.json.encode(report)) + b"\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Startup benchmark: how long a fresh process takes to import the app, build it and run its startup hooks.
+
+Run from the repository root:
+
+    python -m bench.startup [--runs 10] [--storage sqlite]
+
+Every run is a new interpreter, so nothing is shared between runs through module caches. Each one reports three
+phases: importing src.server, building the app with make_app(config), and running its startup hooks (opening storage
+and the job queue, starting the upstream sessions and reconciling the schema against a local fake of Discord). The
+median of each phase is printed at the end.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+from pathlib import Path
+
+import msgspec
+from aiohttp import web
+
+from .fake_upstream import make_fake_discord, make_fake_patreon
+from .load import ROOT, _free_port, _write_config  # pyright: ignore [reportPrivateUsage]
+
+
+class StartupTimings(msgspec.Struct):
+    import_ms: float
+    make_app_ms: float
+    startup_ms: float
+
+
+# Runs in the child. The import is timed first, before anything else from the app has been loaded.
+PROBE = """\
+import time
+start = time.perf_counter()
+import src.server
+imported = time.perf_counter()
+
+import asyncio
+import msgspec
+from aiohttp import web
+from src.config import load_config
+
+async def main():
+    global built, started
+    config = load_config()
+    built_start = time.perf_counter()
+    app = src.server.make_app(config)
+    built = time.perf_counter() - built_start
+    runner = web.AppRunner(app)
+    started_start = time.perf_counter()
+    await runner.setup()
+    started = time.perf_counter() - started_start
+    await runner.cleanup()
+
+asyncio.run(main())
+print(msgspec.json.encode({
+    "import_ms": (imported - start) * 1000, "make_app_ms": built * 1000, "startup_ms": started * 1000,
+}).decode())
+"""
+
+
+async def run_once(directory: Path) -> StartupTimings:
+    env = {**os.environ, "PYTHONPATH": str(ROOT)}
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-c",
+        PROBE,
+        cwd=directory,
+        env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        msg = f"Startup probe exited with {process.returncode}:\n{stderr.decode()}"
+        raise RuntimeError(msg)
+    return msgspec.json.decode(stdout.splitlines()[-1], type=StartupTimings)
+
+
+async def run(args: argparse.Namespace) -> list[StartupTimings]:
+    runners: list[web.AppRunner] = []
+    urls: dict[str, str] = {}
+    for name, fake in {"discord": make_fake_discord(), "patreon": make_fake_patreon()}.items():
+        runner = web.AppRunner(fake, access_log=None)
+        await runner.setup()
+        port = _free_port()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+        urls[name] = f"http://127.0.0.1:{port}"
+
+    timings: list[StartupTimings] = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = Path(tmp)
+            _write_config(directory, _free_port(), urls["discord"], urls["patreon"], args)
+            for index in range(args.runs):
+                result = await run_once(directory)
+                timings.append(result)
+                print(  # noqa: T201
+                    f"run {index + 1:>2}: import {result.import_ms:7.1f} ms  make_app {result.make_app_ms:6.1f} ms"
+                    f"  startup {result.startup_ms:7.1f} ms",
+                )
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="fresh processes to start (default: 10)")
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="sqlite")
+    args = parser.parse_args()
+    # _write_config also wants a worker count; startup is measured for a single process.
+    args.workers = 1
+
+    timings = asyncio.run(run(args))
+    print(  # noqa: T201
+        f"median: import {statistics.median(t.import_ms for t in timings):7.1f} ms"
+        f"  make_app {statistics.median(t.make_app_ms for t in timings):6.1f} ms"
+        f"  startup {statistics.median(t.startup_ms for t in timings):7.1f} ms",
+    )
+
+
+if __name__ == "__main__":
+    main()
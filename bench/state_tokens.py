@@ -0,0 +1,87 @@
+"""Microbenchmark for OAuth state tokens: the HMAC format in src.verify against the Fernet scheme it replaced.
+
+Run from the repository root, next to a config.toml (only its cookie secret is used):
+
+    python -m bench.state_tokens [--iterations 100000]
+
+The legacy functions are inlined below as they were, minus two bugs that kept the original from ever verifying a
+token: the expiry was compared as a string, and the signature was base64 encoded a third time instead of decoded.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import datetime
+import os
+import time
+from collections.abc import Callable
+from typing import Any
+
+import msgspec
+from cryptography import fernet
+
+from src.config import load_config
+from src.verify import derive_state_keys, make_state, verify_state
+
+
+class _LegacyState(msgspec.Struct):
+    state: str
+    expires_at: datetime.datetime
+
+
+def legacy_sign(crypt: fernet.Fernet, state: str, expires: int = 300000) -> bytes:
+    payload_dict: dict[str, Any] = {"state": state}
+    payload_dict["expires_at"] = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires)
+    data = msgspec.json.encode(payload_dict)
+    signature = crypt.encrypt(data)
+    return base64.urlsafe_b64encode(data) + b"." + base64.urlsafe_b64encode(signature)
+
+
+def legacy_verify(crypt: fernet.Fernet, token: bytes) -> str | None:
+    data, _, signature = token.partition(b".")
+    if not signature:
+        return None
+
+    payload = msgspec.json.decode(base64.urlsafe_b64decode(data), type=_LegacyState)
+    if payload.expires_at < datetime.datetime.now(datetime.timezone.utc):
+        return None
+
+    is_valid = crypt.decrypt(base64.urlsafe_b64decode(signature)) == base64.urlsafe_b64decode(data)
+    return payload.state if is_valid else None
+
+
+def measure(func: Callable[[], object], iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100_000, help="Operations per measurement.")
+    args = parser.parse_args()
+
+    config = load_config()
+    crypt = fernet.Fernet(base64.urlsafe_b64encode(config.cookie_secret))
+    keys = derive_state_keys([config.cookie_secret])
+
+    nonce = base64.urlsafe_b64encode(os.urandom(16)).decode()
+    legacy_token = legacy_sign(crypt, nonce)
+    token = make_state(keys)
+    assert legacy_verify(crypt, legacy_token) == nonce
+    assert verify_state(token, keys)
+
+    rows = [
+        ("fernet sign", measure(lambda: legacy_sign(crypt, nonce), args.iterations), len(legacy_token)),
+        ("fernet verify", measure(lambda: legacy_verify(crypt, legacy_token), args.iterations), len(legacy_token)),
+        ("hmac sign", measure(lambda: make_state(keys), args.iterations), len(token)),
+        ("hmac verify", measure(lambda: verify_state(token, keys), args.iterations), len(token)),
+    ]
+    for name, ops, size in rows:
+        print(f"{name:<14} {ops:>12,.0f} ops/s  {size:>4} bytes")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Microbenchmark for the token storage backends under concurrent load.
+
+Run from the repository root:
+
+    python -m bench.storage [--tasks 1000] [--ops 50]
+
+Every reader and writer is its own task, so the numbers reflect how well each backend copes with many coroutines
+touching the store at once. The "global-lock" row reproduces the old single-lock design for comparison, and
+"sqlite-sealed" is the sqlite backend with tokens encrypted at rest.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from src.crypto import TokenCipher
+from src.storage import MemoryTokenStorage, SQLiteTokenStorage, TokenStorage
+from src.structs import TokenRecord
+
+
+class GlobalLockTokenStorage(MemoryTokenStorage):
+    """The previous design: every read and write goes through one lock."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._lock = asyncio.Lock()
+
+    async def store(self, user_id: str, tokens: TokenRecord) -> None:
+        async with self._lock:
+            await self._store(user_id, tokens)
+
+    async def get(self, user_id: str, *, use_cache: bool = True) -> TokenRecord | None:
+        async with self._lock:
+            return self._tokens.get(int(user_id))
+
+
+async def run_workload(storage: TokenStorage, tasks: int, ops: int) -> float:
+    tokens = TokenRecord("access", "refresh", int(time.time()) + 604800)
+
+    async def writer(n: int) -> None:
+        for i in range(ops):
+            await storage.store(str(n * 10 + i % 10), tokens)
+
+    async def reader(n: int) -> None:
+        for i in range(ops):
+            await storage.get(str(n * 10 + i % 10))
+
+    await storage.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(n) for n in range(tasks)), *(reader(n) for n in range(tasks)))
+    elapsed = time.perf_counter() - start
+    await storage.close()
+    return (2 * tasks * ops) / elapsed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=1000, help="Concurrent readers, and separately writers.")
+    parser.add_argument("--ops", type=int, default=50, help="Operations performed by each task.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backends: dict[str, TokenStorage] = {
+            "global-lock": GlobalLockTokenStorage(),
+            "memory": MemoryTokenStorage(),
+            "sqlite": SQLiteTokenStorage(str(Path(tmp) / "bench.sqlite3")),
+            "sqlite-sealed": SQLiteTokenStorage(str(Path(tmp) / "sealed.sqlite3"), cipher=TokenCipher([b"bench"])),
+        }
+        for name, storage in backends.items():
+            throughput = await run_workload(storage, args.tasks, args.ops)
+            print(f"{name:<14} {throughput:>12,.0f} ops/s")  # noqa: T201
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+from pathlib import Path
+
+from main import setup_logging
+from src.config import load_config
+from src.discord import DiscordAPI
+from src.http import make_client
+from src.jobs import JobQueue
+from src.metadata import register_push_jobs
+from src.patreon import PatreonAPI
+from src.ratelimit import DiscordRateLimiter
+from src.schema import DEFAULT_METADATA_SCHEMA, SchemaRegistry
+from src.server import USER_AGENT
+from src.storage import make_token_storage
+from src.sync import bulk_sync, sync_campaign
+
+
+async def run(args: argparse.Namespace) -> None:
+    config = load_config()
+    storage = make_token_storage(config)
+    await storage.start()
+    try:
+        headers = {"User-Agent": USER_AGENT}
+        discord_client = make_client("discord", config.discord.http, headers=headers, ratelimiter=DiscordRateLimiter())
+        patreon_client = make_client("patreon", config.patreon.http, headers=headers)
+        patreon = PatreonAPI(patreon_client, config.patreon, storage)
+        queue = JobQueue(
+            config.jobs.path,
+            workers=args.workers,
+            max_attempts=config.jobs.max_attempts,
+            backoff_base=config.jobs.backoff_base,
+            backoff_max=config.jobs.backoff_max,
+            tracing=config.tracing,
+        )
+        register_push_jobs(
+            queue,
+            DiscordAPI(discord_client, config.discord, storage),
+            patreon,
+            SchemaRegistry(config.discord.metadata_schema or DEFAULT_METADATA_SCHEMA),
+        )
+        await queue.start()
+        try:
+            if args.from_patreon:
+                await sync_campaign(queue, patreon)
+            else:
+                await bulk_sync(queue, storage, batch_size=args.batch_size, checkpoint=args.checkpoint)
+            if not args.no_wait:
+                await queue.wait_idle()
+        finally:
+            await queue.close()
+            await asyncio.gather(discord_client.close(), patreon_client.close())
+    finally:
+        await storage.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Push role connection metadata for every linked user.")
+    parser.add_argument("--workers", type=int, default=32, help="How many pushes to run concurrently.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="How many users to queue per checkpoint.")
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        default=Path("bulk_sync.checkpoint.json"),
+        help="Where to record progress. An existing checkpoint is resumed from.",
+    )
+    parser.add_argument(
+        "--from-patreon",
+        action="store_true",
+        help="Walk the campaign's members on Patreon and push only linked users whose membership changed.",
+    )
+    parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Exit once the pushes are queued, leaving them to the running server's job queue.",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
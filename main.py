@@ -1,23 +1,75 @@
 from __future__ import annotations
 
 import logging
+import multiprocessing
+import signal
+import sys
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
 
 from aiohttp import web
 
+from src.config import load_config
+from src.logs import setup_logging
 from src.server import make_app
+from src.structs import Config
 
 
-def setup_logging() -> None:
-    dt_fmt = "%Y-%m-%d %H:%M:%S"
-    fmt = "[{asctime}] [{levelname:<8}] {name}: {message}"
-    logging.basicConfig(format=fmt, datefmt=dt_fmt, style="{", level=logging.INFO)
-    logging.getLogger("aiohttp").setLevel(logging.WARNING)
+LOGGER = logging.getLogger(__name__)
+
+
+def run_worker(config: Config, reuse_port: bool = False) -> None:
+    setup_logging()
+    app = make_app(config)
+    web.run_app(  # pyright: ignore [reportUnknownMemberType]
+        app,
+        host=config.server.host,
+        port=config.server.port,
+        reuse_port=reuse_port,
+    )
+
+
+def run_prefork(config: Config) -> None:
+    """Run several worker processes that all accept on the same port via SO_REUSEPORT, restarting any that die."""
+
+    workers = config.server.workers
+    if config.storage.backend != "sqlite":
+        LOGGER.warning("Running %d workers with %s storage; tokens won't be shared.", workers, config.storage.backend)
+
+    ctx = multiprocessing.get_context("spawn")
+
+    def spawn(index: int) -> BaseProcess:
+        # Workers get the parsed config rather than reading the file again.
+        process = ctx.Process(target=run_worker, args=(config, True), name=f"worker-{index}")
+        process.start()
+        return process
+
+    # Turn SIGTERM into a normal exit so the workers get shut down below.
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+
+    processes: dict[int, BaseProcess] = {index: spawn(index) for index in range(workers)}
+    LOGGER.info("Started %d workers on port %d.", workers, config.server.port)
+    try:
+        while True:
+            wait([process.sentinel for process in processes.values()])
+            for index, process in list(processes.items()):
+                if not process.is_alive():
+                    LOGGER.warning("Worker %d exited with code %s; restarting it.", index, process.exitcode)
+                    processes[index] = spawn(index)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
 
 
 def main() -> None:
     setup_logging()
-    app = make_app()
-    web.run_app(app, port=80)  # pyright: ignore [reportUnknownMemberType]
+    config = load_config()
+    if config.server.workers > 1:
+        run_prefork(config)
+    else:
+        run_worker(config)
 
 
 if __name__ == "__main__":
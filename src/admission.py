@@ -0,0 +1,118 @@
+"""Admission control for the endpoints that lead to calls to Discord and Patreon.
+
+Each client IP, and each Discord user named in a request, gets a token bucket. Requests that find their bucket empty
+are turned away with a 429 before any work is done, so a flood from one source can't spend the rate limit budget
+everyone shares upstream.
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from collections.abc import Awaitable, Callable, Hashable
+
+from aiohttp import web
+from aiohttp.typedefs import Middleware
+
+from .metrics import Counter
+from .structs import AdmissionConfig
+
+
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections_total",
+    "Requests turned away with a 429 by admission control, by what they were limited on.",
+    ("limit",),
+)
+
+# Only these routes are limited. Those taking a user_id query parameter are also limited per user.
+LIMITED_PATHS = frozenset({"/linked-role", "/discord/redirect", "/patreon/redirect", "/update-metadata"})
+USER_LIMITED_PATHS = frozenset({"/update-metadata"})
+
+
+class TokenBuckets:
+    """Token buckets for many keys, each refilling at `rate` tokens a second up to `burst`.
+
+    Each bucket is stored as a single float, the time at which it will be full again (the generic cell rate
+    algorithm), so there's no separate token count or timestamp to keep. A bucket that is full again carries no
+    information, so it can be dropped; that's done in a sweep at most every `sweep_interval` seconds. If there are
+    still more than `max_entries` buckets after that, the oldest are dropped, which only ever errs towards admitting.
+    """
+
+    def __init__(self, rate: float, burst: int, *, max_entries: int = 100_000, sweep_interval: float = 60) -> None:
+        self.interval = 1 / rate
+        # How far ahead of now a bucket's full time can be while it still has a token left.
+        self.tolerance = self.interval * (burst - 1)
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._full_at: dict[Hashable, float] = {}
+        self._next_sweep = 0.0
+
+    def __len__(self) -> int:
+        return len(self._full_at)
+
+    def acquire(self, key: Hashable, now: float | None = None) -> float:
+        """Take a token for a key. Returns 0 if one was taken, or else how many seconds until one will be available."""
+
+        if now is None:
+            now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+        full_at = max(self._full_at.get(key, now), now)
+        wait = full_at - now - self.tolerance
+        if wait > 0:
+            return wait
+        self._full_at[key] = full_at + self.interval
+        return 0
+
+    def sweep(self, now: float | None = None) -> None:
+        if now is None:
+            now = time.monotonic()
+        self._next_sweep = now + self.sweep_interval
+        self._full_at = {key: full_at for key, full_at in self._full_at.items() if full_at > now}
+        if (excess := len(self._full_at) - self.max_entries) > 0:
+            for key in list(self._full_at)[:excess]:
+                del self._full_at[key]
+
+
+def _too_many_requests(limit: str, retry_after: float) -> web.HTTPTooManyRequests:
+    ADMISSION_REJECTIONS.labels(limit).inc()
+    return web.HTTPTooManyRequests(
+        text="Too many requests. Try again shortly.",
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
+
+
+def make_admission_middleware(config: AdmissionConfig) -> Middleware:
+    ip_buckets = TokenBuckets(
+        config.ip_rate,
+        config.ip_burst,
+        max_entries=config.max_entries,
+        sweep_interval=config.sweep_interval,
+    )
+    user_buckets = TokenBuckets(
+        config.user_rate,
+        config.user_burst,
+        max_entries=config.max_entries,
+        sweep_interval=config.sweep_interval,
+    )
+
+    @web.middleware
+    async def admission_middleware(
+        request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+    ) -> web.StreamResponse:
+        resource = request.match_info.route.resource
+        path = resource.canonical if resource is not None else None
+        if path in LIMITED_PATHS:
+            now = time.monotonic()
+            if retry_after := ip_buckets.acquire(request.remote, now):
+                raise _too_many_requests("ip", retry_after)
+            # Discord ids are snowflakes; keying by the int keeps the table small and ignores formatting tricks.
+            user_id = request.query.get("user_id", "")
+            if path in USER_LIMITED_PATHS and user_id.isdigit():
+                if retry_after := user_buckets.acquire(int(user_id), now):
+                    raise _too_many_requests("user", retry_after)
+        return await handler(request)
+
+    return admission_middleware
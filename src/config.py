@@ -10,8 +10,10 @@ from .structs import Config
 
 LOGGER = logging.getLogger(__name__)
 
-with pathlib.Path("config.toml").open(encoding="utf-8") as f:
-    LOGGER.debug("Reading config file...")
-    data = f.read()
+DEFAULT_CONFIG_PATH = "config.toml"
+
+
+def load_config(path: str | pathlib.Path = DEFAULT_CONFIG_PATH) -> Config:
+    LOGGER.debug("Reading config file %s...", path)
+    return msgspec.toml.decode(pathlib.Path(path).read_bytes(), type=Config)
 
-CONFIG = msgspec.toml.decode(data, type=Config)
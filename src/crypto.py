@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import struct
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+# Sealed records: version (1 byte) | key id (4) | DEK nonce (12) | wrapped DEK (32 + 16 tag) | nonce (12) | ciphertext
+# with its 16 byte tag. Every record gets its own data encryption key (DEK), wrapped by a key encryption key (KEK)
+# derived from one of the configured secrets. Both layers are AES-256-GCM with the record's owner in the associated
+# data, so a sealed record can't be moved to another user's row. The key id is only bound to the wrapped DEK, which is
+# what lets a rotation rewrite just that part.
+SEALED_VERSION = 1
+_HEADER = struct.Struct(">BI")
+_NONCE_SIZE = 12
+_DEK_SIZE = 32
+_WRAPPED_DEK_SIZE = _DEK_SIZE + 16
+_BODY_OFFSET = _HEADER.size + _NONCE_SIZE + _WRAPPED_DEK_SIZE
+
+
+class UnknownKeyError(Exception):
+    """A sealed record names a key that isn't configured."""
+
+    def __init__(self, key_id: int) -> None:
+        self.key_id = key_id
+        super().__init__(f"No configured key has id {key_id:08x}.")
+
+
+def is_sealed(blob: bytes) -> bool:
+    """Whether a stored blob was sealed, as opposed to written in plaintext before encryption was turned on."""
+
+    return len(blob) > _BODY_OFFSET and blob[0] == SEALED_VERSION
+
+
+class TokenCipher:
+    """Envelope encryption for token records at rest.
+
+    The first secret seals; every secret can open, so records sealed before a rotation can still be read. Moving a
+    record to the new key only rewraps its DEK (see `rewrap`); the encrypted record itself is kept as it is.
+    """
+
+    def __init__(self, secrets: Sequence[bytes]) -> None:
+        if not secrets:
+            msg = "At least one secret is needed to encrypt tokens."
+            raise ValueError(msg)
+        # Imported here so nothing pays for it unless encryption is turned on.
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self._aead = AESGCM
+        self._keys = [self._derive_key(secret) for secret in secrets]
+        self._keys_by_id = dict(reversed(self._keys))
+        self.primary_key_id = self._keys[0][0]
+
+    def _derive_key(self, secret: bytes) -> tuple[int, AESGCM]:
+        # As with the OAuth state keys, the configured secret isn't used directly.
+        key = hashlib.blake2b(secret, digest_size=32, person=b"token-kek").digest()
+        key_id = int.from_bytes(hashlib.blake2b(key, digest_size=4, person=b"token-kek-id").digest())
+        return key_id, self._aead(key)
+
+    def _wrap(self, owner: bytes, dek: bytes) -> bytes:
+        key_id, kek = self._keys[0]
+        header = _HEADER.pack(SEALED_VERSION, key_id)
+        dek_nonce = os.urandom(_NONCE_SIZE)
+        return header + dek_nonce + kek.encrypt(dek_nonce, dek, header + owner)
+
+    def _unwrap(self, owner: bytes, blob: bytes) -> bytes:
+        _, key_id = _HEADER.unpack_from(blob)
+        try:
+            kek = self._keys_by_id[key_id]
+        except KeyError:
+            raise UnknownKeyError(key_id) from None
+        dek_nonce = blob[_HEADER.size : _HEADER.size + _NONCE_SIZE]
+        return kek.decrypt(dek_nonce, blob[_HEADER.size + _NONCE_SIZE : _BODY_OFFSET], blob[: _HEADER.size] + owner)
+
+    def seal(self, owner: bytes, plaintext: bytes) -> bytes:
+        dek = os.urandom(_DEK_SIZE)
+        nonce = os.urandom(_NONCE_SIZE)
+        body = self._aead(dek).encrypt(nonce, plaintext, bytes((SEALED_VERSION,)) + owner)
+        return self._wrap(owner, dek) + nonce + body
+
+    def open(self, owner: bytes, blob: bytes) -> bytes:
+        dek = self._unwrap(owner, blob)
+        nonce, body = blob[_BODY_OFFSET : _BODY_OFFSET + _NONCE_SIZE], blob[_BODY_OFFSET + _NONCE_SIZE :]
+        return self._aead(dek).decrypt(nonce, body, bytes((SEALED_VERSION,)) + owner)
+
+    def needs_rewrap(self, blob: bytes) -> bool:
+        return _HEADER.unpack_from(blob)[1] != self.primary_key_id
+
+    def rewrap(self, owner: bytes, blob: bytes) -> bytes:
+        """Rewrap a sealed record's DEK with the primary key."""
+
+        return self._wrap(owner, self._unwrap(owner, blob)) + blob[_BODY_OFFSET:]
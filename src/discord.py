@@ -1,26 +1,48 @@
 from __future__ import annotations
 
-import datetime
+import hashlib
 import logging
+import time
 import urllib.parse
+from collections import OrderedDict
 from enum import IntEnum
 from typing import Any
 
 import msgspec
-from aiohttp import BasicAuth, ClientSession
-
-from .config import CONFIG
-from .storage import store_discord_tokens
-from .structs import AccessTokenObject, OAuth2UserInfo, SchemaField
+from aiohttp import BasicAuth, ClientResponse
+
+from .http import HTTPClient
+from .refresh import SingleFlight
+from .responses import EncodedBody
+from .storage import (
+    TokenStorage,
+    delete_discord_tokens,
+    get_discord_tokens,
+    get_metadata_digest,
+    store_discord_tokens,
+    store_metadata_digest,
+)
+from .structs import (
+    AccessTokenObject,
+    DiscordConfig,
+    OAuth2ErrorResponse,
+    OAuth2UserInfo,
+    RoleConnection,
+    SchemaField,
+    TokenRecord,
+)
 
 
 LOGGER = logging.getLogger(__name__)
 
-DISCORD_BASE_API = "https://discord.com/api/v10"
 DISCORD_AUTH_URL = "https://discord.com/oauth2/authorize"
-DISCORD_TOKEN_URL = f"{DISCORD_BASE_API}/oauth2/token"
 
-DISCORD_AUTH = BasicAuth(CONFIG.discord.client_id, CONFIG.discord.client_secret)
+# Decoders are built once; decoding straight into structs skips building and then validating intermediate dicts.
+_TOKEN_DECODER = msgspec.json.Decoder(AccessTokenObject)
+_OAUTH_ERROR_DECODER = msgspec.json.Decoder(OAuth2ErrorResponse)
+_USER_INFO_DECODER = msgspec.json.Decoder(OAuth2UserInfo)
+_ROLE_CONNECTION_DECODER = msgspec.json.Decoder(RoleConnection)
+_SCHEMA_DECODER = msgspec.json.Decoder(list[SchemaField])
 
 
 class RoleConnAttrType(IntEnum):
@@ -34,11 +56,61 @@ class RoleConnAttrType(IntEnum):
     BOOL_NEQ = 8
 
 
-def prepare_discord_authorization_request(state: bytes) -> str:
+class RoleConnectionCache:
+    """A short-lived LRU cache of users' role connections as last read from Discord, encoded as response bodies.
+
+    Keeping the encoded body means a cache hit costs no encoding or hashing, and its ETag stays the same. Entries are
+    dropped when this process pushes new metadata for the user. Pushes made by other worker processes
+    aren't seen, so the TTL bounds how stale an entry can get.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 30) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, EncodedBody]] = OrderedDict()
+
+    def get(self, user_id: str) -> EncodedBody | None:
+        try:
+            expires_at, body = self._data[user_id]
+        except KeyError:
+            return None
+
+        if expires_at < time.monotonic():
+            del self._data[user_id]
+            return None
+
+        self._data.move_to_end(user_id)
+        return body
+
+    def put(self, user_id: str, body: EncodedBody) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self._data[user_id] = (time.monotonic() + self.ttl, body)
+        self._data.move_to_end(user_id)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        self._data.pop(user_id, None)
+
+
+class DiscordAPI:
+    """What calls to Discord on behalf of an app need: its client, its Discord config, its token store and its cache."""
+
+    __slots__ = ("client", "config", "storage", "role_connections")
+
+    def __init__(self, client: HTTPClient, config: DiscordConfig, storage: TokenStorage) -> None:
+        self.client = client
+        self.config = config
+        self.storage = storage
+        self.role_connections = RoleConnectionCache(config.role_connection_cache_size, config.role_connection_cache_ttl)
+
+
+def prepare_discord_authorization_request(config: DiscordConfig, state: str) -> str:
     search_params = urllib.parse.urlencode(
         {
-            "client_id": CONFIG.discord.client_id,
-            "redirect_uri": CONFIG.discord.redirect_uri,
+            "client_id": config.client_id,
+            "redirect_uri": config.redirect_uri,
             "response_type": "code",
             "state": state,
             "scope": "role_connections.write identify",
@@ -49,17 +121,24 @@ def prepare_discord_authorization_request(state: bytes) -> str:
     return url
 
 
-async def make_discord_token_request(client: ClientSession, code: str) -> AccessTokenObject:
+async def make_discord_token_request(discord: DiscordAPI, code: str) -> TokenRecord:
+    config = discord.config
     data = {
         "grant_type": "authorization_code",
         "code": code,
-        "redirect_uri": CONFIG.discord.redirect_uri,
+        "redirect_uri": config.redirect_uri,
     }
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
     }
 
-    async with client.post(DISCORD_TOKEN_URL, data=data, headers=headers, auth=DISCORD_AUTH) as response:
+    async with discord.client.post(
+        f"{config.api_base}/oauth2/token",
+        data=data,
+        headers=headers,
+        auth=BasicAuth(config.client_id, config.client_secret),
+        route="POST /oauth2/token",
+    ) as response:
         try:
             response.raise_for_status()
         except Exception as err:
@@ -67,13 +146,33 @@ async def make_discord_token_request(client: ClientSession, code: str) -> Access
             err.add_note(note)
             raise
         else:
-            result = msgspec.json.decode(await response.read(), type=AccessTokenObject)
-            LOGGER.debug("get_oauth_tokens result: %s", result)
-            return result
+            return TokenRecord.issued(_TOKEN_DECODER.decode(await response.read()))
+
+
+DISCORD_REFRESHES: SingleFlight[TokenRecord] = SingleFlight("discord")
+
 
+async def _is_invalid_grant(response: ClientResponse) -> bool:
+    if response.status != 400:
+        return False
+    try:
+        return _OAUTH_ERROR_DECODER.decode(await response.read()).error == "invalid_grant"
+    except msgspec.DecodeError:
+        return False
+
+
+async def _refresh_discord_tokens(discord: DiscordAPI, user_id: str, tokens: TokenRecord) -> TokenRecord:
+    config = discord.config
+    # The lease keeps other worker processes sharing the token store from refreshing the same user at the same time;
+    # SingleFlight already takes care of other tasks in this process.
+    async with discord.storage.lease(f"refresh:discord:{user_id}"):
+        # A refresh that finished just before this one started, here or in another process, will already have rotated
+        # the refresh token. Using the old one again would fail, so reuse what was stored instead.
+        current = await get_discord_tokens(discord.storage, user_id, use_cache=False)
+        if current is not None and current.refresh_token != tokens.refresh_token:
+            DISCORD_REFRESHES.reuse(user_id)
+            return current
 
-async def prepare_discord_refresh_token_request(client: ClientSession, user_id: str, tokens: AccessTokenObject) -> str:
-    if tokens.expires_at and (datetime.datetime.now().astimezone() > tokens.expires_at):
         data = {
             "grant_type": "refresh_token",
             "refresh_token": tokens.refresh_token,
@@ -82,28 +181,69 @@ async def prepare_discord_refresh_token_request(client: ClientSession, user_id:
             "Content-Type": "application/x-www-form-urlencoded",
         }
 
-        async with client.post(DISCORD_TOKEN_URL, data=data, headers=headers, auth=DISCORD_AUTH) as response:
+        async with discord.client.post(
+            f"{config.api_base}/oauth2/token",
+            data=data,
+            headers=headers,
+            auth=BasicAuth(config.client_id, config.client_secret),
+            route="POST /oauth2/token",
+        ) as response:
+            # Read before raise_for_status(), which releases the response.
+            invalid_grant = await _is_invalid_grant(response)
             try:
                 response.raise_for_status()
             except Exception as err:
                 note = f"Error refreshing access token: [{response.status}] {response.reason}"  # pyright: ignore [reportUnknownMemberType]
                 err.add_note(note)
+                if invalid_grant:
+                    # The user revoked the app, or the grant is otherwise dead, and retrying would only fail the same
+                    # way. Without stored tokens they have to authorize again, and the refresh scheduler stops
+                    # picking them up. Nothing else is treated as terminal: a 401 means the client credentials are
+                    # wrong, which is no reason to throw away every user's tokens.
+                    await delete_discord_tokens(discord.storage, user_id)
+                    err.add_note(f"Deleted the stored tokens for user {user_id}.")
+                elif response.status == 401:
+                    LOGGER.exception("Discord rejected the client credentials; check the Discord client id and secret.")
                 raise
             else:
-                new_tokens = msgspec.json.decode(await response.read(), type=AccessTokenObject)
-                await store_discord_tokens(user_id, new_tokens)
-                return new_tokens.access_token
+                new_tokens = TokenRecord.issued(_TOKEN_DECODER.decode(await response.read()))
+                await store_discord_tokens(discord.storage, user_id, new_tokens)
+                return new_tokens
+
+
+async def refresh_discord_tokens(discord: DiscordAPI, user_id: str, tokens: TokenRecord) -> TokenRecord:
+    """Refresh and store a user's tokens. Concurrent calls for the same user share one request to Discord."""
+
+    return await DISCORD_REFRESHES.do(user_id, lambda: _refresh_discord_tokens(discord, user_id, tokens))
+
+
+async def prepare_discord_refresh_token_request(discord: DiscordAPI, user_id: str, tokens: TokenRecord) -> str:
+    if tokens.expires_within():
+        new_tokens = await refresh_discord_tokens(discord, user_id, tokens)
+        return new_tokens.access_token
 
     return tokens.access_token
 
 
-async def get_user_data(client: ClientSession, tokens: AccessTokenObject) -> OAuth2UserInfo:
-    url = f"{DISCORD_BASE_API}/oauth2/@me"
+def _token_major(access_token: str) -> str:
+    # Routes called before the user id is known are limited per token. Key their buckets by a hash of it, so the
+    # token itself isn't kept in the rate limiter or shown in its logs.
+    return hashlib.blake2b(access_token.encode(), digest_size=8).hexdigest()
+
+
+async def get_user_data(discord: DiscordAPI, tokens: TokenRecord) -> OAuth2UserInfo:
+    config = discord.config
+    url = f"{config.api_base}/oauth2/@me"
     headers = {
         "Authorization": f"Bearer {tokens.access_token}",
     }
 
-    async with client.get(url, headers=headers) as response:
+    async with discord.client.get(
+        url,
+        headers=headers,
+        route="GET /oauth2/@me",
+        major=_token_major(tokens.access_token),
+    ) as response:
         try:
             response.raise_for_status()
         except Exception as err:
@@ -111,29 +251,54 @@ async def get_user_data(client: ClientSession, tokens: AccessTokenObject) -> OAu
             err.add_note(note)
             raise
         else:
-            result = msgspec.json.decode(await response.read(), type=OAuth2UserInfo)
+            result = _USER_INFO_DECODER.decode(await response.read())
             LOGGER.debug("get_user_data result: %s", result)
             return result
 
 
+def metadata_digest(data: dict[str, Any]) -> bytes:
+    return hashlib.blake2b(msgspec.json.encode(data, order="sorted"), digest_size=16).digest()
+
+
 async def push_metadata(
-    client: ClientSession,
+    discord: DiscordAPI,
     user_id: str,
-    tokens: AccessTokenObject,
+    tokens: TokenRecord,
     metadata: dict[str, Any],
-) -> None:
-    url = f"{DISCORD_BASE_API}/users/@me/applications/{CONFIG.discord.client_id}/role-connection"
-    access_token = await prepare_discord_refresh_token_request(client, user_id, tokens)
+    *,
+    force: bool = False,
+) -> bool:
+    """Push a user's role connection metadata to Discord.
+
+    The PUT is skipped if it would send exactly what was last pushed successfully, unless `force` is set. Returns
+    whether anything was sent.
+    """
+
+    config = discord.config
+
     data = {
         "platform_name": "Example Linked role Discord Bot",
         "metadata": metadata,
     }
+    digest = metadata_digest(data)
+    if not force and await get_metadata_digest(discord.storage, user_id) == digest:
+        LOGGER.debug("Metadata for user %s is unchanged; skipping push.", user_id)
+        return False
+
+    url = f"{config.api_base}/users/@me/applications/{config.client_id}/role-connection"
+    access_token = await prepare_discord_refresh_token_request(discord, user_id, tokens)
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}",
     }
 
-    async with client.put(url, data=msgspec.json.encode(data), headers=headers) as response:
+    async with discord.client.put(
+        url,
+        data=msgspec.json.encode(data),
+        headers=headers,
+        route="PUT /users/@me/applications/{application.id}/role-connection",
+        major=user_id,
+    ) as response:
         try:
             response.raise_for_status()
         except Exception as err:
@@ -141,15 +306,30 @@ async def push_metadata(
             err.add_note(note)
             raise
 
+    discord.role_connections.invalidate(user_id)
+    await store_metadata_digest(discord.storage, user_id, digest)
+    return True
 
-async def get_cookie_metadata(client: ClientSession, user_id: str, tokens: AccessTokenObject) -> dict[str, Any]:
-    url = f"{DISCORD_BASE_API}/users/@me/applications/{CONFIG.discord.client_id}/role-connection"
-    access_token = await prepare_discord_refresh_token_request(client, user_id, tokens)
+
+async def get_cookie_metadata(discord: DiscordAPI, user_id: str, tokens: TokenRecord) -> EncodedBody:
+    """Get a user's role connection as a JSON body, from the cache if possible and otherwise from Discord."""
+
+    if (body := discord.role_connections.get(user_id)) is not None:
+        return body
+
+    config = discord.config
+    url = f"{config.api_base}/users/@me/applications/{config.client_id}/role-connection"
+    access_token = await prepare_discord_refresh_token_request(discord, user_id, tokens)
     headers = {
         "Authorization": f"Bearer {access_token}",
     }
 
-    async with client.get(url, headers=headers) as response:
+    async with discord.client.get(
+        url,
+        headers=headers,
+        route="GET /users/@me/applications/{application.id}/role-connection",
+        major=user_id,
+    ) as response:
         try:
             response.raise_for_status()
         except Exception as err:
@@ -157,40 +337,27 @@ async def get_cookie_metadata(client: ClientSession, user_id: str, tokens: Acces
             err.add_note(note)
             raise
         else:
-            result = msgspec.json.decode(await response.read())
+            result = _ROLE_CONNECTION_DECODER.decode(await response.read())
             LOGGER.debug("get_cookie_metadata result: %s", result)
-            return result
+            body = EncodedBody.encode(result)
+            discord.role_connections.put(user_id, body)
+            return body
 
 
-async def register_metadata_schema(client: ClientSession) -> dict[str, Any]:
-    schema = [
-        SchemaField(
-            key="cookieseaten",
-            name="Cookies Eaten",
-            description="Cookies Eaten Greater Than",
-            type=RoleConnAttrType.NUM_GREAT_THAN,
-        ),
-        SchemaField(
-            key="allergictonuts",
-            name="Allergic To Nuts",
-            description="Is Allergic To Nuts",
-            type=RoleConnAttrType.BOOL_EQ,
-        ),
-        SchemaField(
-            key="bakingsince",
-            name="Baking Since",
-            description="Days since baking their first cookie",
-            type=RoleConnAttrType.DATETIME_GREAT_THAN,
-        ),
-    ]
-
-    url = f"{DISCORD_BASE_API}/applications/{CONFIG.discord.client_id}/role-connections/metadata"
+async def register_metadata_schema(discord: DiscordAPI, schema: list[SchemaField]) -> list[SchemaField]:
+    config = discord.config
+    url = f"{config.api_base}/applications/{config.client_id}/role-connections/metadata"
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bot {CONFIG.discord.token}",
+        "Authorization": f"Bot {config.token}",
     }
 
-    async with client.put(url, data=msgspec.json.encode(schema), headers=headers) as response:
+    async with discord.client.put(
+        url,
+        data=msgspec.json.encode(schema),
+        headers=headers,
+        route="PUT /applications/{application.id}/role-connections/metadata",
+    ) as response:
         try:
             response.raise_for_status()
         except Exception as err:
@@ -200,19 +367,24 @@ async def register_metadata_schema(client: ClientSession) -> dict[str, Any]:
             err.add_note(text)
             raise
         else:
-            result = msgspec.json.decode(await response.read())
+            result = _SCHEMA_DECODER.decode(await response.read())
             LOGGER.debug("register_metadata_schema result: %s", result)
             return result
 
 
-async def get_metadata_schema(client: ClientSession) -> dict[str, Any]:
-    url = f"{DISCORD_BASE_API}/applications/{CONFIG.discord.client_id}/role-connections/metadata"
+async def get_metadata_schema(discord: DiscordAPI) -> list[SchemaField]:
+    config = discord.config
+    url = f"{config.api_base}/applications/{config.client_id}/role-connections/metadata"
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bot {CONFIG.discord.token}",
+        "Authorization": f"Bot {config.token}",
     }
 
-    async with client.get(url, headers=headers) as response:
+    async with discord.client.get(
+        url,
+        headers=headers,
+        route="GET /applications/{application.id}/role-connections/metadata",
+    ) as response:
         try:
             response.raise_for_status()
         except Exception as err:
@@ -220,6 +392,6 @@ async def get_metadata_schema(client: ClientSession) -> dict[str, Any]:
             err.add_note(note)
             raise
         else:
-            result = msgspec.json.decode(await response.read())
+            result = _SCHEMA_DECODER.decode(await response.read())
             LOGGER.debug("get_metadata_schema result: %s", result)
             return result
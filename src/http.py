@@ -0,0 +1,520 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+from types import SimpleNamespace
+from typing import Any
+
+import msgspec
+from aiohttp import ClientResponse, ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+from .metrics import (
+    UPSTREAM_REQUEST_DURATION,
+    UPSTREAM_REQUESTS,
+    CallbackMetric,
+    Counter,
+    EndpointMetrics,
+    Histogram,
+)
+from .ratelimit import DiscordRateLimiter
+from .structs import ConnectionPoolConfig
+from .tracing import span
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _RateLimitedBody(msgspec.Struct):
+    retry_after: float
+    is_global: bool = msgspec.field(default=False, name="global")
+
+
+_RATE_LIMITED_DECODER = msgspec.json.Decoder(_RateLimitedBody)
+
+
+async def _read_retry_after(response: ClientResponse) -> tuple[float, bool]:
+    try:
+        body = _RATE_LIMITED_DECODER.decode(await response.read())
+    except msgspec.DecodeError:
+        # Not from Discord's API itself, e.g. a Cloudflare block page. Fall back to the header.
+        return float(response.headers.get("Retry-After", 1)), False
+    else:
+        return body.retry_after, body.is_global
+
+
+POOL_WAIT_DURATION = Histogram(
+    "upstream_pool_wait_seconds",
+    "Time requests spent waiting for a free connection because the pool was at its limit.",
+    ("upstream",),
+)
+
+
+class PoolStats:
+    """How much of one session's connection pool is in use.
+
+    `in_flight` counts requests from when they ask for a connection until their response is released, so it includes
+    those still waiting for one. `waiting` and `queued` count requests that found the pool at its limit; if that
+    happens regularly at peak, the pool is too small.
+    """
+
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.waiting = 0
+        self.queued = 0
+        self.created = 0
+        self.reused = 0
+        self._wait_duration = POOL_WAIT_DURATION.labels(name)
+        _POOLS.append(self)
+
+    def trace_config(self) -> TraceConfig:
+        async def on_queued_start(_: ClientSession, context: SimpleNamespace, __: object) -> None:
+            self.waiting += 1
+            self.queued += 1
+            context.queued_at = time.perf_counter()
+
+        async def on_queued_end(_: ClientSession, context: SimpleNamespace, __: object) -> None:
+            self.waiting -= 1
+            self._wait_duration.observe(time.perf_counter() - context.queued_at)
+
+        async def on_create_end(*_: Any) -> None:
+            self.created += 1
+
+        async def on_reuse(*_: Any) -> None:
+            self.reused += 1
+
+        trace_config = TraceConfig()
+        trace_config.on_connection_queued_start.append(on_queued_start)
+        trace_config.on_connection_queued_end.append(on_queued_end)
+        trace_config.on_connection_create_end.append(on_create_end)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        return trace_config
+
+    def acquire(self) -> None:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "waiting": self.waiting,
+            "queued": self.queued,
+            "created": self.created,
+            "reused": self.reused,
+        }
+
+
+_POOLS: list[PoolStats] = []
+
+
+def _pool_connections() -> dict[tuple[str, ...], float]:
+    samples: dict[tuple[str, ...], float] = {}
+    for pool in _POOLS:
+        samples[pool.name, "created"] = pool.created
+        samples[pool.name, "reused"] = pool.reused
+    return samples
+
+
+CallbackMetric(
+    "upstream_pool_limit",
+    "Maximum connections in each upstream's pool.",
+    ("upstream",),
+    lambda: {(pool.name,): pool.limit for pool in _POOLS},
+)
+CallbackMetric(
+    "upstream_pool_in_flight",
+    "Requests holding or waiting for a connection, by upstream.",
+    ("upstream",),
+    lambda: {(pool.name,): pool.in_flight for pool in _POOLS},
+)
+CallbackMetric(
+    "upstream_pool_peak_in_flight",
+    "Highest number of requests holding or waiting for a connection at once since startup, by upstream.",
+    ("upstream",),
+    lambda: {(pool.name,): pool.peak_in_flight for pool in _POOLS},
+)
+CallbackMetric(
+    "upstream_pool_waiting",
+    "Requests currently waiting for a free connection, by upstream.",
+    ("upstream",),
+    lambda: {(pool.name,): pool.waiting for pool in _POOLS},
+)
+CallbackMetric(
+    "upstream_pool_connections_total",
+    "Connections handed out by each upstream's pool, newly created or reused.",
+    ("upstream", "kind"),
+    _pool_connections,
+    type="counter",
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to an upstream whose circuit breaker is open."""
+
+    def __init__(self, upstream: str, retry_after: float) -> None:
+        super().__init__(f"The circuit for {upstream} is open; not sending requests for {retry_after:.0f}s.")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+CIRCUIT_REJECTIONS = Counter(
+    "upstream_circuit_rejections_total",
+    "Requests not sent because the upstream's circuit breaker was open.",
+    ("upstream",),
+)
+HEDGED_REQUESTS = Counter(
+    "upstream_hedged_requests_total",
+    "Requests that were slow enough to have a second copy sent, by upstream and route.",
+    ("upstream", "route"),
+)
+
+
+class CircuitBreaker:
+    """Stops sending requests to an upstream that is failing, so callers fail fast instead of waiting out timeouts.
+
+    Outcomes are counted in one-second buckets over a rolling `window`. Once at least `min_requests` have been seen in
+    the window and `failure_rate` of them failed (errors and 5xx responses), the circuit opens and requests are
+    rejected for `open_for` seconds. After that it is half-open: `probes` requests are let through, and the circuit
+    closes if they succeed or opens again if one fails.
+    """
+
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        window: float = 30,
+        min_requests: int = 20,
+        failure_rate: float = 0.5,
+        open_for: float = 30,
+        probes: int = 1,
+    ) -> None:
+        self.name = name
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.open_for = open_for
+        self.probes = probes
+        self.state = self.CLOSED
+        self.opened = 0
+        self._open_until = 0.0
+        self._probing = 0
+        # [second, successes, failures]
+        self._buckets = [[0, 0, 0] for _ in range(max(int(window), 1))]
+        self._rejections = CIRCUIT_REJECTIONS.labels(name)
+        _BREAKERS.append(self)
+
+    def _bucket(self, now: float) -> list[int]:
+        second = int(now)
+        bucket = self._buckets[second % len(self._buckets)]
+        if bucket[0] != second:
+            bucket[:] = [second, 0, 0]
+        return bucket
+
+    def _window_counts(self, now: float) -> tuple[int, int]:
+        oldest = int(now) - len(self._buckets) + 1
+        successes = failures = 0
+        for second, ok, failed in self._buckets:
+            if second >= oldest:
+                successes += ok
+                failures += failed
+        return successes, failures
+
+    def _open(self, now: float) -> None:
+        self.state = self.OPEN
+        self.opened += 1
+        self._open_until = now + self.open_for
+        self._probing = 0
+        LOGGER.warning("Opened the circuit for %s; rejecting requests for %.0fs.", self.name, self.open_for)
+
+    def before_request(self) -> None:
+        """Raise CircuitOpenError if the request shouldn't be sent. Otherwise, report its outcome afterwards."""
+
+        if self.state == self.CLOSED:
+            return
+
+        now = time.monotonic()
+        if self.state == self.OPEN and now >= self._open_until:
+            self.state = self.HALF_OPEN
+            LOGGER.info("Circuit for %s is half-open; probing.", self.name)
+        if self.state == self.HALF_OPEN and self._probing < self.probes:
+            self._probing += 1
+            return
+
+        self._rejections.inc()
+        raise CircuitOpenError(self.name, max(self._open_until - now, 1))
+
+    def on_success(self) -> None:
+        if self.state == self.HALF_OPEN:
+            self.state = self.CLOSED
+            for bucket in self._buckets:
+                bucket[:] = [0, 0, 0]
+            LOGGER.info("Closed the circuit for %s.", self.name)
+        self._bucket(time.monotonic())[1] += 1
+
+    def on_failure(self) -> None:
+        now = time.monotonic()
+        if self.state == self.HALF_OPEN:
+            self._open(now)
+            return
+
+        self._bucket(now)[2] += 1
+        if self.state == self.CLOSED:
+            successes, failures = self._window_counts(now)
+            total = successes + failures
+            if total >= self.min_requests and failures >= total * self.failure_rate:
+                self._open(now)
+
+    def on_abandoned(self) -> None:
+        """Report a request that was cancelled before it had an outcome."""
+
+        if self.state == self.HALF_OPEN:
+            self._probing = max(self._probing - 1, 0)
+
+
+_BREAKERS: list[CircuitBreaker] = []
+
+CallbackMetric(
+    "upstream_circuit_state",
+    "State of each upstream's circuit breaker: 0 closed, 1 half-open, 2 open.",
+    ("upstream",),
+    lambda: {(breaker.name,): breaker.state for breaker in _BREAKERS},
+)
+CallbackMetric(
+    "upstream_circuit_opened_total",
+    "Times each upstream's circuit breaker has opened.",
+    ("upstream",),
+    lambda: {(breaker.name,): breaker.opened for breaker in _BREAKERS},
+    type="counter",
+)
+
+
+class HTTPClient:
+    """The HTTP layer that all calls to one upstream go through.
+
+    With a rate limiter attached, requests wait for their bucket before being sent and 429 responses are retried after
+    the delay Discord asks for instead of being surfaced to the caller. With a circuit breaker attached, requests fail
+    fast with CircuitOpenError while the upstream is down. Every attempt is recorded in the upstream metrics under
+    `name` and the request's route.
+
+    Idempotent requests can be hedged: if no response has arrived after `hedge_after` seconds, a second copy is sent
+    and whichever answers first is used. A client with a rate limiter never hedges. The copy would wait on the same
+    bucket as the first request, so it couldn't cut the wait, and once the bucket's limit is known it would spend
+    another request from it.
+    """
+
+    def __init__(
+        self,
+        session: ClientSession,
+        *,
+        name: str = "",
+        ratelimiter: DiscordRateLimiter | None = None,
+        pool: PoolStats | None = None,
+        breaker: CircuitBreaker | None = None,
+        hedge_after: float | None = None,
+        max_retries: int = 5,
+    ) -> None:
+        self.session = session
+        self.name = name
+        self.ratelimiter = ratelimiter
+        self.pool = pool
+        self.breaker = breaker
+        self.hedge_after = hedge_after
+        self.max_retries = max_retries
+        self._endpoint_metrics: dict[str, EndpointMetrics] = {}
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    @asynccontextmanager
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        route: str | None = None,
+        major: str = "",
+        hedge: bool = False,
+        **kwargs: Any,
+    ) -> AsyncIterator[ClientResponse]:
+        """Send a request and yield the response.
+
+        `route` identifies the endpoint for rate limiting and metrics, and defaults to the method and URL. Pass it for
+        any URL containing ids or a query string. `major` separates rate limits that Discord applies per user rather
+        than per route, e.g. for requests using a user's bearer token. `hedge` allows hedging the request, if the
+        client hedges at all (clients with a rate limiter don't); only pass it for requests that are safe to send twice.
+        """
+
+        route = route or f"{method} {url}"
+        if hedge and self.hedge_after is not None and self.ratelimiter is None:
+            response = await self._send_hedged(method, url, route, major, **kwargs)
+        else:
+            response = await self._send(method, url, route, major, **kwargs)
+        try:
+            yield response
+        finally:
+            self._release(response)
+
+    def _release(self, response: ClientResponse) -> None:
+        response.release()
+        if self.pool is not None:
+            self.pool.release()
+
+    async def _attempt(self, method: str, url: str, route: str, **kwargs: Any) -> ClientResponse:
+        try:
+            metrics = self._endpoint_metrics[route]
+        except KeyError:
+            metrics = EndpointMetrics(UPSTREAM_REQUEST_DURATION, UPSTREAM_REQUESTS, self.name, route)
+            self._endpoint_metrics[route] = metrics
+
+        if self.breaker is not None:
+            self.breaker.before_request()
+        if self.pool is not None:
+            self.pool.acquire()
+        start = time.perf_counter()
+        try:
+            with span("upstream", upstream=self.name, route=route) as upstream_span:
+                response = await self.session.request(method, url, **kwargs)
+                upstream_span.set("status", response.status)
+        except BaseException as err:
+            metrics.observe(0, time.perf_counter() - start)
+            if self.pool is not None:
+                self.pool.release()
+            if self.breaker is not None:
+                if isinstance(err, asyncio.CancelledError):
+                    self.breaker.on_abandoned()
+                else:
+                    self.breaker.on_failure()
+            raise
+        metrics.observe(response.status, time.perf_counter() - start)
+        if self.breaker is not None:
+            if response.status >= 500:
+                self.breaker.on_failure()
+            else:
+                self.breaker.on_success()
+        return response
+
+    async def _send(self, method: str, url: str, route: str, major: str, **kwargs: Any) -> ClientResponse:
+        if self.ratelimiter is None:
+            return await self._attempt(method, url, route, **kwargs)
+
+        attempt = 0
+        while True:
+            async with self.ratelimiter.acquire(route, major):
+                response = await self._attempt(method, url, route, **kwargs)
+                self.ratelimiter.update(route, major, response)
+                if response.status != 429 or attempt >= self.max_retries:
+                    return response
+
+                retry_after, is_global = await _read_retry_after(response)
+                self._release(response)
+                if is_global:
+                    self.ratelimiter.set_global_limit(retry_after)
+                LOGGER.warning("Rate limited on %s (global=%s); retrying in %.2fs.", route, is_global, retry_after)
+                # Sleep inside acquire(): if the bucket is still held, nothing else queued on it jumps ahead.
+                await asyncio.sleep(retry_after)
+                attempt += 1
+
+    async def _send_hedged(self, method: str, url: str, route: str, major: str, **kwargs: Any) -> ClientResponse:
+        assert self.hedge_after is not None
+        pending = {asyncio.create_task(self._send(method, url, route, major, **kwargs))}
+        hedged = False
+        error: BaseException | None = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=None if hedged else self.hedge_after,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    hedged = True
+                    HEDGED_REQUESTS.labels(self.name, route).inc()
+                    pending.add(asyncio.create_task(self._send(method, url, route, major, **kwargs)))
+                    continue
+
+                winner = None
+                for task in done:
+                    if (exc := task.exception()) is not None:
+                        error = error or exc
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        self._release(task.result())
+                if winner is not None:
+                    return winner
+        finally:
+            for task in pending:
+                task.cancel()
+                # It may already have a response that nobody will read.
+                task.add_done_callback(self._release_unused)
+
+        assert error is not None
+        raise error
+
+    def _release_unused(self, task: asyncio.Task[ClientResponse]) -> None:
+        if not task.cancelled() and task.exception() is None:
+            self._release(task.result())
+
+    def get(self, url: str, **kwargs: Any) -> AbstractAsyncContextManager[ClientResponse]:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> AbstractAsyncContextManager[ClientResponse]:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs: Any) -> AbstractAsyncContextManager[ClientResponse]:
+        return self.request("PUT", url, **kwargs)
+
+
+def make_client(
+    name: str,
+    config: ConnectionPoolConfig,
+    *,
+    headers: dict[str, str] | None = None,
+    ratelimiter: DiscordRateLimiter | None = None,
+) -> HTTPClient:
+    """Create a client with its own session and connection pool for one upstream. Must be called in a running loop."""
+
+    pool = PoolStats(name, config.limit)
+    connector = TCPConnector(
+        limit=config.limit,
+        limit_per_host=config.limit_per_host,
+        keepalive_timeout=config.keepalive_timeout,
+        ttl_dns_cache=config.dns_cache_ttl,
+    )
+    timeout = ClientTimeout(
+        total=config.total_timeout,
+        connect=config.pool_timeout,
+        sock_connect=config.connect_timeout,
+        sock_read=config.read_timeout,
+    )
+    session = ClientSession(connector=connector, timeout=timeout, headers=headers, trace_configs=[pool.trace_config()])
+    breaker = None
+    if config.breaker_enabled:
+        breaker = CircuitBreaker(
+            name,
+            window=config.breaker_window,
+            min_requests=config.breaker_min_requests,
+            failure_rate=config.breaker_failure_rate,
+            open_for=config.breaker_open_for,
+        )
+    return HTTPClient(
+        session,
+        name=name,
+        ratelimiter=ratelimiter,
+        pool=pool,
+        breaker=breaker,
+        hedge_after=config.hedge_after,
+    )
@@ -0,0 +1,373 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import time
+import uuid
+from collections.abc import Awaitable, Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Generic, TypeVar
+
+import msgspec
+
+from .metrics import Counter
+from .structs import TracingConfig
+from .tracing import traced
+
+
+if TYPE_CHECKING:
+    import sqlite3
+
+T = TypeVar("T")
+
+LOGGER = logging.getLogger(__name__)
+
+JOBS = Counter("jobs_total", "Background jobs run, by kind and outcome.", ("kind", "outcome"))
+
+
+class DeadJob(msgspec.Struct):
+    """A job that failed on every attempt and was set aside."""
+
+    id: int
+    kind: str
+    key: str
+    attempts: int
+    error: str
+    failed_at: float
+
+
+class _Handler(Generic[T]):
+    def __init__(
+        self,
+        payload_type: type[T],
+        func: Callable[[str, T], Awaitable[object]],
+        merge: Callable[[T, T], T] | None,
+    ) -> None:
+        self.func = func
+        self.merge = merge
+        self.encoder = msgspec.msgpack.Encoder()
+        self.decoder = msgspec.msgpack.Decoder(payload_type)
+
+
+class JobQueue:
+    """A durable queue of background jobs, stored in SQLite so pending work survives restarts.
+
+    A job has a kind, which picks the handler that runs it, and a key. There is at most one pending job per kind and
+    key: enqueueing another replaces the payload of the one waiting (or merges the two, if the kind has a merge
+    function), so only the latest work for e.g. a user is done. If that job is already running, it runs again with the
+    new payload once it finishes.
+
+    Up to `workers` jobs run at once. A job that fails is retried after an exponential backoff with jitter, and after
+    `max_attempts` attempts it's moved to the dead letter table. Any number of processes can share the database; a job
+    is claimed by one of them for `lock_timeout` seconds, after which it's run again if its claimant didn't finish it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        workers: int = 8,
+        max_attempts: int = 8,
+        backoff_base: float = 1,
+        backoff_max: float = 300,
+        lock_timeout: float = 300,
+        poll_interval: float = 1,
+        tracing: TracingConfig | None = None,
+    ) -> None:
+        self.path = path
+        self.tracing = tracing or TracingConfig()
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._owner = uuid.uuid4().hex
+        self._handlers: dict[str, _Handler[Any]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-queue")
+        self._conn: sqlite3.Connection | None = None
+        self._semaphore = asyncio.Semaphore(workers)
+        self._wakeup = asyncio.Event()
+        self._tasks: set[asyncio.Task[None]] = set()
+        self._runner: asyncio.Task[None] | None = None
+
+    def register(
+        self,
+        kind: str,
+        payload_type: type[T],
+        func: Callable[[str, T], Awaitable[object]],
+        *,
+        merge: Callable[[T, T], T] | None = None,
+    ) -> None:
+        """Set the handler for a kind of job. `merge(old, new)` combines a waiting job's payload with a new one's."""
+
+        self._handlers[kind] = _Handler(payload_type, func, merge)
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _open(self) -> None:
+        import sqlite3
+
+        # Autocommit mode, so transactions can be started with BEGIN IMMEDIATE below.
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        # run_at is when the job is next due. A claimed job's run_at is pushed out to the end of its claim, so a job
+        # whose claimant died comes due again by itself.
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, key TEXT NOT NULL, "
+            "payload BLOB NOT NULL, run_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "version INTEGER NOT NULL DEFAULT 0, owner TEXT, UNIQUE (kind, key))",
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_run_at ON jobs (run_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS dead_jobs (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, key TEXT NOT NULL, "
+            "payload BLOB NOT NULL, attempts INTEGER NOT NULL, error TEXT NOT NULL, failed_at REAL NOT NULL)",
+        )
+        self._conn = conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        assert self._conn
+        # Take the write lock up front; upgrading a read transaction can fail outright when another process writes.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
+
+    def _write_jobs(self, kind: str, items: list[tuple[str, bytes]], run_at: float) -> None:
+        handler = self._handlers[kind]
+        with self._transaction() as conn:
+            for key, new_payload in items:
+                payload = new_payload
+                if handler.merge is not None:
+                    row = conn.execute("SELECT payload FROM jobs WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+                    if row is not None:
+                        merged = handler.merge(handler.decoder.decode(row[0]), handler.decoder.decode(new_payload))
+                        payload = handler.encoder.encode(merged)
+                # A waiting job is brought forward if need be. A running one keeps its claim; the version bump tells
+                # its claimant to leave it queued when it finishes.
+                conn.execute(
+                    "INSERT INTO jobs (kind, key, payload, run_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (kind, key) DO UPDATE SET payload = excluded.payload, attempts = 0, "
+                    "version = version + 1, "
+                    "run_at = CASE WHEN owner IS NULL THEN min(run_at, excluded.run_at) ELSE run_at END",
+                    (kind, key, payload, run_at),
+                )
+
+    def _claim(self) -> tuple[int, str, str, bytes, int, int] | None:
+        now = time.time()
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE jobs SET owner = ?, run_at = ?, attempts = attempts + 1 "
+                "WHERE id = (SELECT id FROM jobs WHERE run_at <= ? ORDER BY run_at LIMIT 1) "
+                "RETURNING id, kind, key, payload, attempts, version",
+                (self._owner, now + self.lock_timeout, now),
+            ).fetchone()
+
+    def _next_due(self) -> float | None:
+        assert self._conn
+        row = self._conn.execute("SELECT min(run_at) FROM jobs").fetchone()
+        return row[0]
+
+    def _complete(self, job_id: int, version: int) -> None:
+        with self._transaction() as conn:
+            deleted = conn.execute(
+                "DELETE FROM jobs WHERE id = ? AND owner = ? AND version = ?",
+                (job_id, self._owner, version),
+            ).rowcount
+            if not deleted:
+                # It was enqueued again while running. Release it so the new payload runs.
+                conn.execute(
+                    "UPDATE jobs SET owner = NULL, run_at = ? WHERE id = ? AND owner = ?",
+                    (time.time(), job_id, self._owner),
+                )
+
+    def _fail(self, job_id: int, version: int, error: str) -> bool:
+        """Schedule a retry of a failed job, or move it to the dead letters. Returns whether it will be retried."""
+
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT kind, key, payload, attempts, version FROM jobs WHERE id = ? AND owner = ?",
+                (job_id, self._owner),
+            ).fetchone()
+            if row is None:
+                # The claim ran out and someone else has it now.
+                return True
+
+            kind, key, payload, attempts, current_version = row
+            if current_version == version and attempts >= self.max_attempts:
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                conn.execute(
+                    "INSERT INTO dead_jobs (kind, key, payload, attempts, error, failed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (kind, key, payload, attempts, error, time.time()),
+                )
+                return False
+
+            # A new payload arrived while this one was failing, so its attempts were reset; keep backing off anyway,
+            # since whatever failed is likely to fail again right away.
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (max(attempts, 1) - 1))
+            delay *= random.uniform(0.5, 1.0)
+            conn.execute("UPDATE jobs SET owner = NULL, run_at = ? WHERE id = ?", (time.time() + delay, job_id))
+            return True
+
+    def _count(self) -> dict[str, int]:
+        assert self._conn
+        now = time.time()
+        # A claim that ran out counts as pending again, since it will be.
+        running, pending = self._conn.execute(
+            "SELECT count(*) FILTER (WHERE owner IS NOT NULL AND run_at > ?), "
+            "count(*) FILTER (WHERE owner IS NULL OR run_at <= ?) FROM jobs",
+            (now, now),
+        ).fetchone()
+        (dead,) = self._conn.execute("SELECT count(*) FROM dead_jobs").fetchone()
+        return {"pending": pending, "running": running, "dead": dead}
+
+    def _read_dead(self, limit: int) -> list[DeadJob]:
+        assert self._conn
+        query = "SELECT id, kind, key, attempts, error, failed_at FROM dead_jobs ORDER BY id DESC LIMIT ?"
+        return [DeadJob(*row) for row in self._conn.execute(query, (limit,))]
+
+    def _requeue_dead(self) -> int:
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute("DELETE FROM dead_jobs RETURNING kind, key, payload").fetchall()
+            # A newer job for the same key supersedes the dead one.
+            conn.executemany(
+                "INSERT INTO jobs (kind, key, payload, run_at) VALUES (?, ?, ?, ?) ON CONFLICT (kind, key) DO NOTHING",
+                [(kind, key, payload, now) for kind, key, payload in rows],
+            )
+            return len(rows)
+
+    async def start(self) -> None:
+        await self._run(self._open)
+        self._runner = asyncio.create_task(self._dispatch())
+        LOGGER.info("Opened job queue at %s", self.path)
+
+    async def close(self) -> None:
+        """Stop taking jobs and wait for the running ones to finish. Jobs not yet run stay queued for next time."""
+
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._conn:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    async def enqueue(self, kind: str, key: str, payload: object, *, delay: float = 0) -> None:
+        await self.enqueue_many(kind, [(key, payload)], delay=delay)
+
+    async def enqueue_many(self, kind: str, items: Iterable[tuple[str, object]], *, delay: float = 0) -> None:
+        """Enqueue several jobs of one kind in a single transaction."""
+
+        encoder = self._handlers[kind].encoder
+        encoded = [(key, encoder.encode(payload)) for key, payload in items]
+        await self._run(self._write_jobs, kind, encoded, time.time() + delay)
+        self._wakeup.set()
+
+    async def stats(self) -> dict[str, int]:
+        return await self._run(self._count)
+
+    async def dead_letters(self, limit: int = 100) -> list[DeadJob]:
+        """Get the most recent dead letters."""
+
+        return await self._run(self._read_dead, limit)
+
+    async def requeue_dead_letters(self) -> int:
+        """Move every dead letter back onto the queue with a fresh set of attempts. Returns how many were moved."""
+
+        count = await self._run(self._requeue_dead)
+        self._wakeup.set()
+        return count
+
+    async def wait_idle(self) -> None:
+        """Wait until no jobs are left to run, by this process or any other."""
+
+        while True:
+            stats = await self.stats()
+            if not stats["pending"] and not stats["running"]:
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    async def _dispatch(self) -> None:
+        while True:
+            await self._semaphore.acquire()
+            try:
+                job = await self._run(self._claim)
+            except Exception:
+                self._semaphore.release()
+                LOGGER.exception("Could not claim a job.")
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            if job is not None:
+                task = asyncio.create_task(self._work(*job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+
+            self._semaphore.release()
+            # Sleep until the next job is due, or something is enqueued here. Other processes can enqueue too, so
+            # never sleep longer than the poll interval.
+            next_due = await self._run(self._next_due)
+            timeout = self.poll_interval
+            if next_due is not None:
+                timeout = min(max(next_due - time.time(), 0), timeout)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _work(self, job_id: int, kind: str, key: str, payload: bytes, attempts: int, version: int) -> None:
+        try:
+            handler = self._handlers[kind]
+            with traced(f"job {kind}", self.tracing, key=key, attempt=attempts):
+                await handler.func(key, handler.decoder.decode(payload))
+        except Exception as err:
+            await self._record_failure(job_id, kind, key, attempts, version, err)
+        else:
+            JOBS.labels(kind, "completed").inc()
+            try:
+                await self._run(self._complete, job_id, version)
+            except Exception:
+                # The job will run again once its claim runs out.
+                LOGGER.exception("Could not mark job %s for %s as done.", kind, key)
+        finally:
+            self._semaphore.release()
+
+    async def _record_failure(
+        self,
+        job_id: int,
+        kind: str,
+        key: str,
+        attempts: int,
+        version: int,
+        err: Exception,
+    ) -> None:
+        try:
+            retrying = await self._run(self._fail, job_id, version, repr(err))
+        except Exception:
+            LOGGER.exception("Could not record the failure of job %s for %s.", kind, key)
+            return
+
+        if retrying:
+            JOBS.labels(kind, "retried").inc()
+            LOGGER.warning("Job %s for %s failed on attempt %d; retrying.", kind, key, attempts, exc_info=err)
+        else:
+            JOBS.labels(kind, "dead").inc()
+            LOGGER.error("Job %s for %s failed on attempt %d; giving up.", kind, key, attempts, exc_info=err)
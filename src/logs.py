@@ -0,0 +1,150 @@
+"""Logging as JSON lines, written from a background thread, with secrets redacted before anything is formatted."""
+
+from __future__ import annotations
+
+import atexit
+import datetime
+import logging
+import queue
+import re
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
+
+import msgspec
+
+from .tracing import current_trace_id
+
+
+# Fields of any struct that are never logged, whatever struct they're in.
+SECRET_FIELDS = frozenset(
+    {
+        "access_token",
+        "refresh_token",
+        "client_secret",
+        "token",
+        "creator_access_token",
+        "creator_refresh_token",
+        "cookie_secret",
+        "previous_cookie_secrets",
+        "webhook_secret",
+        "admin_token",
+        "encryption_keys",
+        "code",
+    },
+)
+# Credentials as they appear in free text: authorization headers, and form or query parameters.
+_SECRET_PATTERN = re.compile(
+    r"(?i)((?:bearer|bot|basic)\s+|\b(?:access_token|refresh_token|client_secret|code)['\"]?\s*[=:]\s*['\"]?)"
+    r"[^\s'\"&,;)}]+",
+)
+_REDACTED = "[redacted]"
+_ENCODER = msgspec.json.Encoder()
+
+
+def redact_text(text: str) -> str:
+    return _SECRET_PATTERN.sub(rf"\1{_REDACTED}", text)
+
+
+def _redact_struct(value: msgspec.Struct) -> str:
+    parts: list[str] = []
+    for name in value.__struct_fields__:
+        field = getattr(value, name)
+        if name in SECRET_FIELDS:
+            parts.append(f"{name}={_REDACTED!r}")
+        elif isinstance(field, msgspec.Struct):
+            parts.append(f"{name}={_redact_struct(field)}")
+        else:
+            parts.append(f"{name}={redact(field)!r}")
+    return f"{type(value).__name__}({', '.join(parts)})"
+
+
+def redact(value: Any) -> Any:
+    """Redact a value about to be logged. Structs become their repr with secret fields blanked out."""
+
+    if isinstance(value, str):
+        return redact_text(value)
+    if isinstance(value, msgspec.Struct):
+        return _redact_struct(value)
+    if isinstance(value, dict):
+        items: dict[Any, Any] = value  # pyright: ignore [reportUnknownVariableType]
+        return {key: _REDACTED if key in SECRET_FIELDS else redact(item) for key, item in items.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]  # pyright: ignore [reportUnknownVariableType]
+    if isinstance(value, tuple):
+        return tuple(redact(item) for item in value)  # pyright: ignore [reportUnknownVariableType]
+    return value
+
+
+class _ContextFilter(logging.Filter):
+    """Runs on the thread that logged: redacts the record's arguments and tags it with the current trace id."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.msg, str):
+            record.msg = redact_text(record.msg)
+        if isinstance(record.args, tuple):
+            record.args = tuple(redact(arg) for arg in record.args)
+        elif record.args:
+            record.args = redact(record.args)
+        if not hasattr(record, "trace_id"):
+            record.trace_id = current_trace_id()
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock handler formats the message here, on the thread that logged it. The queue never leaves this
+        # process and the arguments have already been redacted, so leave the formatting to the listener's thread.
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if (trace_id := getattr(record, "trace_id", None)) is not None:
+            entry["trace_id"] = trace_id
+        if (trace := getattr(record, "trace", None)) is not None:
+            entry["trace"] = trace
+        if record.exc_info:
+            entry["exc"] = redact_text(self.formatException(record.exc_info))
+        elif record.exc_text:
+            entry["exc"] = redact_text(record.exc_text)
+        return _ENCODER.encode(entry).decode()
+
+
+_listener: QueueListener | None = None
+
+
+def setup_logging(level: int = logging.INFO) -> QueueListener:
+    """Send every log record through a queue to a background thread that writes it to stderr as a JSON line.
+
+    Only the first call in a process sets anything up; later calls return the listener it started.
+    """
+
+    global _listener  # noqa: PLW0603
+    if _listener is not None:
+        return _listener
+
+    records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(JSONFormatter())
+    listener = QueueListener(records, stream, respect_handler_level=True)
+
+    handler = _QueueHandler(records)
+    handler.addFilter(_ContextFilter())
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    logging.getLogger("aiohttp").setLevel(logging.WARNING)
+
+    listener.start()
+    # Flush whatever is still queued on the way out.
+    atexit.register(listener.stop)
+    _listener = listener
+    return listener
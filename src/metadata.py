@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import logging
+from typing import Any
+
+from .discord import DiscordAPI, push_metadata
+from .jobs import JobQueue
+from .patreon import PatreonAPI, get_patreon_membership
+from .schema import SchemaRegistry
+from .storage import get_discord_tokens, get_patreon_link
+from .structs import PatreonMembership, PushMetadataJob, TokenRecord
+
+
+LOGGER = logging.getLogger(__name__)
+
+PUSH_METADATA = "push_metadata"
+
+
+def membership_to_metadata(membership: PatreonMembership | None) -> dict[str, Any]:
+    if membership is None or membership.patron_status != "active_patron":
+        return {"patron": 0, "pledgecents": 0}
+
+    metadata: dict[str, Any] = {
+        "patron": 1,
+        "pledgecents": membership.currently_entitled_amount_cents,
+    }
+    if membership.pledge_relationship_start is not None:
+        metadata["patronsince"] = membership.pledge_relationship_start.isoformat()
+    return metadata
+
+
+async def build_metadata(patreon: PatreonAPI, user_id: str) -> dict[str, Any]:
+    membership = None
+    try:
+        link = await get_patreon_link(patreon.storage, user_id)
+        if link is not None and link.member_id is not None:
+            membership = await get_patreon_membership(patreon, link.patreon_user_id, link.member_id)
+    except Exception as err:
+        err.add_note("Error fetching external data.")
+        raise
+
+    return membership_to_metadata(membership)
+
+
+async def update_metadata_helper(
+    discord: DiscordAPI,
+    patreon: PatreonAPI,
+    schema: SchemaRegistry,
+    user_id: str,
+    *,
+    tokens: TokenRecord | None = None,
+    metadata: dict[str, Any] | None = None,
+    force: bool = False,
+) -> bool:
+    """Build and push a user's metadata. Callers that already have the tokens or the metadata can pass them in."""
+
+    if tokens is None:
+        tokens = await get_discord_tokens(discord.storage, user_id)
+    assert tokens
+
+    if metadata is None:
+        metadata = await build_metadata(patreon, user_id)
+    schema.validate(metadata)
+    return await push_metadata(discord, user_id, tokens, metadata, force=force)
+
+
+def register_push_jobs(queue: JobQueue, discord: DiscordAPI, patreon: PatreonAPI, schema: SchemaRegistry) -> None:
+    """Have the job queue run queued metadata pushes against the given APIs, validated by the given schema."""
+
+    async def push(user_id: str, job: PushMetadataJob) -> None:
+        tokens = await get_discord_tokens(discord.storage, user_id)
+        if tokens is None:
+            # Retrying won't help; the push is queued again when they link their Discord account.
+            LOGGER.info("Dropping a metadata push for user %s, who has no Discord tokens.", user_id)
+            return
+        await update_metadata_helper(discord, patreon, schema, user_id, tokens=tokens, force=job.force)
+
+    def merge(old: PushMetadataJob, new: PushMetadataJob) -> PushMetadataJob:
+        return PushMetadataJob(force=old.force or new.force)
+
+    queue.register(PUSH_METADATA, PushMetadataJob, push, merge=merge)
+
+
+async def enqueue_push(queue: JobQueue, user_id: str, *, force: bool = False, delay: float = 0) -> None:
+    """Queue a push of a user's metadata. Metadata is built when the push runs, so it's always current.
+
+    A user has at most one queued push, so pushes queued with a delay collapse into one if more are queued before it
+    runs.
+    """
+
+    await queue.enqueue(PUSH_METADATA, user_id, PushMetadataJob(force=force), delay=delay)
@@ -0,0 +1,257 @@
+"""A small Prometheus-compatible metrics layer.
+
+Metric families are declared once at import time. Hot paths bind label values ahead of time via `.labels()` and keep
+the returned child, so recording a sample is an attribute update with no lookups or allocations. Each worker process
+keeps its own metrics; scrape every worker if running several.
+"""
+
+from __future__ import annotations
+
+import bisect
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from typing import Any
+
+from aiohttp import web
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STORAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> None:
+        self._metrics.append(metric)
+
+    def render(self) -> bytes:
+        """Render every metric in the Prometheus text exposition format."""
+
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        lines.append("")
+        return "\n".join(lines).encode()
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        *,
+        registry: Registry = REGISTRY,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], Any] = {}
+        registry.register(self)
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def labels(self, *values: str) -> Any:
+        if len(values) != len(self.labelnames):
+            msg = f"{self.name} takes {len(self.labelnames)} label values, got {len(values)}."
+            raise ValueError(msg)
+        try:
+            return self._children[values]
+        except KeyError:
+            child = self._children[values] = self._new_child()
+            return child
+
+    def collect(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def labels(self, *values: str) -> _CounterChild:
+        return super().labels(*values)
+
+    def collect(self) -> Iterator[str]:
+        for values, child in self._children.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        # One slot per bucket plus a final one for +Inf. Counts are per bucket; they are made cumulative on render.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        *,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+        registry: Registry = REGISTRY,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def labels(self, *values: str) -> _HistogramChild:
+        return super().labels(*values)
+
+    def collect(self) -> Iterator[str]:
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), child.counts, strict=True):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {child.sum}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric(_Metric):
+    """A metric whose samples are read from elsewhere at scrape time, for values something already keeps count of."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...],
+        func: Callable[[], dict[tuple[str, ...], float]],
+        *,
+        type: str = "gauge",  # noqa: A002
+        registry: Registry = REGISTRY,
+    ) -> None:
+        self.type = type
+        self.func = func
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def collect(self) -> Iterator[str]:
+        for values, value in self.func().items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {value}"
+
+
+class EndpointMetrics:
+    """Pre-bound children for one endpoint: its latency histogram and a request counter per status code.
+
+    A status of 0 stands for a request that failed without a response.
+    """
+
+    __slots__ = ("_counter", "_labels", "_statuses", "duration")
+
+    def __init__(self, histogram: Histogram, counter: Counter, *labels: str) -> None:
+        self.duration = histogram.labels(*labels)
+        self._counter = counter
+        self._labels = labels
+        self._statuses: dict[int, _CounterChild] = {}
+
+    def observe(self, status: int, elapsed: float) -> None:
+        self.duration.observe(elapsed)
+        try:
+            self._statuses[status].inc()
+        except KeyError:
+            child = self._statuses[status] = self._counter.labels(*self._labels, str(status) if status else "error")
+            child.inc()
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "Requests handled, by route and status.", ("route", "method", "status"))
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling requests, by route.",
+    ("route", "method"),
+)
+UPSTREAM_REQUESTS = Counter(
+    "upstream_requests_total",
+    "Requests sent to Discord and Patreon, by endpoint and status. Retries count separately.",
+    ("upstream", "endpoint", "status"),
+)
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "upstream_request_duration_seconds",
+    "Time until Discord or Patreon responded, by endpoint.",
+    ("upstream", "endpoint"),
+)
+STORAGE_OPERATION_DURATION = Histogram(
+    "storage_operation_duration_seconds",
+    "Time spent in token storage operations.",
+    ("operation",),
+    buckets=STORAGE_BUCKETS,
+)
+
+
+_route_metrics: dict[Any, EndpointMetrics] = {}
+_UNMATCHED = object()
+
+
+@web.middleware
+async def metrics_middleware(
+    request: web.Request,
+    handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+) -> web.StreamResponse:
+    route = request.match_info.route
+    # Requests that matched no route get a fresh route object every time, so they share one key instead.
+    key = route if route.resource is not None else _UNMATCHED
+    try:
+        metrics = _route_metrics[key]
+    except KeyError:
+        path = route.resource.canonical if route.resource is not None else "unmatched"
+        metrics = _route_metrics[key] = EndpointMetrics(HTTP_REQUEST_DURATION, HTTP_REQUESTS, path, route.method)
+
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+    except web.HTTPException as err:
+        status = err.status
+        raise
+    finally:
+        metrics.observe(status, time.perf_counter() - start)
+    return response
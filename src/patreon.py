@@ -1,51 +1,139 @@
 from __future__ import annotations
 
-import datetime
+import hashlib
+import hmac
 import logging
+import time
 import urllib.parse
+from collections import OrderedDict
+from collections.abc import AsyncIterator
 
 import msgspec
-from aiohttp import ClientSession, BasicAuth
+from aiohttp import BasicAuth
 
-from .config import CONFIG
-from .structs import AccessTokenObject
-from .verify import sign
+from .http import HTTPClient
+from .storage import TokenStorage, get_discord_tokens, get_patreon_link, store_patreon_link
+from .structs import (
+    AccessTokenObject,
+    PatreonCampaigns,
+    PatreonConfig,
+    PatreonIdentity,
+    PatreonLink,
+    PatreonMemberDocument,
+    PatreonMembership,
+    PatreonMembersPage,
+    TokenRecord,
+)
 
 
 LOGGER = logging.getLogger(__name__)
 
-PATREON_BASE_API = "https://www.patreon.com/api"
 PATREON_AUTH_URL = "https://www.patreon.com/oauth2/authorize"
-PATREON_TOKEN_URL = f"{PATREON_BASE_API}/oauth2/token"
 
-PATREON_AUTH = BasicAuth(CONFIG.patreon.client_id, CONFIG.patreon.client_secret)
+MEMBER_FIELDS = "patron_status,currently_entitled_amount_cents,pledge_relationship_start"
 
+_TOKEN_DECODER = msgspec.json.Decoder(AccessTokenObject)
+_IDENTITY_DECODER = msgspec.json.Decoder(PatreonIdentity)
+_CAMPAIGNS_DECODER = msgspec.json.Decoder(PatreonCampaigns)
+_MEMBERS_PAGE_DECODER = msgspec.json.Decoder(PatreonMembersPage)
+# Also used for webhook bodies, which are the same document.
+MEMBER_DOCUMENT_DECODER = msgspec.json.Decoder(PatreonMemberDocument)
 
-def prepare_patreon_authorization_request(state: bytes) -> str:
+
+class MembershipCache:
+    """An LRU cache of Patreon memberships keyed by Patreon user id, whose entries expire after a TTL.
+
+    Webhooks keep entries current; the TTL only bounds how stale an entry can get if a webhook is missed.
+    """
+
+    def __init__(self, maxsize: int = 100_000, ttl: float = 3600) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, PatreonMembership]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, patreon_user_id: str) -> PatreonMembership | None:
+        try:
+            expires_at, membership = self._data[patreon_user_id]
+        except KeyError:
+            return None
+
+        if expires_at < time.monotonic():
+            del self._data[patreon_user_id]
+            return None
+
+        self._data.move_to_end(patreon_user_id)
+        return membership
+
+    def put(self, patreon_user_id: str, membership: PatreonMembership) -> bool:
+        """Cache a membership. Returns whether it differs from what was cached before."""
+
+        previous = self._data.get(patreon_user_id)
+        self._data[patreon_user_id] = (time.monotonic() + self.ttl, membership)
+        self._data.move_to_end(patreon_user_id)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return previous is None or previous[1] != membership
+
+    def invalidate(self, patreon_user_id: str) -> None:
+        self._data.pop(patreon_user_id, None)
+
+
+class PatreonAPI:
+    """What calls to Patreon on behalf of an app need: its client, its Patreon config, its token store and its cache."""
+
+    __slots__ = ("client", "config", "storage", "memberships")
+
+    def __init__(self, client: HTTPClient, config: PatreonConfig, storage: TokenStorage) -> None:
+        self.client = client
+        self.config = config
+        self.storage = storage
+        self.memberships = MembershipCache(config.membership_cache_size, config.membership_cache_ttl)
+
+
+def verify_webhook_signature(config: PatreonConfig, body: bytes, signature: str) -> bool:
+    """Check a webhook body against its X-Patreon-Signature header, which is a hex HMAC-MD5 keyed by the secret."""
+
+    if not config.webhook_secret:
+        return False
+    expected = hmac.new(config.webhook_secret.encode(), body, hashlib.md5).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def prepare_patreon_authorization_request(config: PatreonConfig, state: str) -> str:
     search_params = urllib.parse.urlencode(
         {
-            "client_id": CONFIG.patreon.client_id,
-            "redirect_uri": CONFIG.patreon.redirect_uri,
+            "client_id": config.client_id,
+            "redirect_uri": config.redirect_uri,
             "response_type": "code",
-            "state": sign(state),
-            "scope": "users pledges-to-me my-campaign",
+            "state": state,
+            "scope": "identity identity.memberships",
         },
     )
     url = f"{PATREON_AUTH_URL}?{search_params}"
     return url
 
 
-async def make_patreon_token_request(client: ClientSession, code: str) -> AccessTokenObject:
+async def make_patreon_token_request(patreon: PatreonAPI, code: str) -> TokenRecord:
+    config = patreon.config
     data = {
         "grant_type": "authorization_code",
         "code": code,
-        "redirect_uri": CONFIG.patreon.redirect_uri,
+        "redirect_uri": config.redirect_uri,
     }
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
     }
 
-    async with client.post(PATREON_TOKEN_URL, data=data, headers=headers, auth=PATREON_AUTH) as response:
+    async with patreon.client.post(
+        f"{config.api_base}/oauth2/token",
+        data=data,
+        headers=headers,
+        auth=BasicAuth(config.client_id, config.client_secret),
+        route="POST /oauth2/token",
+    ) as response:
         try:
             response.raise_for_status()
         except Exception as err:
@@ -53,31 +141,163 @@ async def make_patreon_token_request(client: ClientSession, code: str) -> Access
             err.add_note(note)
             raise
         else:
-            result = msgspec.json.decode(await response.read(), type=AccessTokenObject)
-            LOGGER.debug("get_oauth_tokens result: %s", result)
+            return TokenRecord.issued(_TOKEN_DECODER.decode(await response.read()))
+
+
+async def get_patreon_identity(patreon: PatreonAPI, tokens: TokenRecord) -> PatreonIdentity:
+    config = patreon.config
+    search_params = urllib.parse.urlencode(
+        {
+            "include": "memberships.campaign",
+            "fields[user]": "social_connections",
+            "fields[member]": MEMBER_FIELDS,
+        },
+    )
+    url = f"{config.api_base}/oauth2/v2/identity?{search_params}"
+    headers = {
+        "Authorization": f"Bearer {tokens.access_token}",
+    }
+
+    async with patreon.client.get(url, headers=headers, route="GET /oauth2/v2/identity", hedge=True) as response:
+        try:
+            response.raise_for_status()
+        except Exception as err:
+            note = f"Error fetching Patreon identity: [{response.status}] {response.reason}"  # pyright: ignore [reportUnknownMemberType]
+            err.add_note(note)
+            raise
+        else:
+            result = _IDENTITY_DECODER.decode(await response.read())
+            LOGGER.debug("get_patreon_identity result: %s", result)
             return result
 
 
-async def prepare_patreon_refresh_token_request(client: ClientSession, user_id: str, tokens: AccessTokenObject) -> str:
-    if tokens.expires_at and (datetime.datetime.now().astimezone() > tokens.expires_at):
-        data = {
-            "grant_type": "refresh_token",
-            "refresh_token": tokens.refresh_token,
-        }
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-        }
+async def get_patreon_membership(patreon: PatreonAPI, patreon_user_id: str, member_id: str) -> PatreonMembership:
+    """Get a membership, from the cache if possible and otherwise from Patreon using the creator's token."""
+
+    if (membership := patreon.memberships.get(patreon_user_id)) is not None:
+        return membership
+
+    config = patreon.config
+    search_params = urllib.parse.urlencode(
+        {
+            "include": "currently_entitled_tiers,user",
+            "fields[member]": MEMBER_FIELDS,
+        },
+    )
+    url = f"{config.api_base}/oauth2/v2/members/{member_id}?{search_params}"
+    headers = {
+        "Authorization": f"Bearer {config.creator_access_token}",
+    }
+
+    route = "GET /oauth2/v2/members/{member.id}"
+    async with patreon.client.get(url, headers=headers, route=route, hedge=True) as response:
+        try:
+            response.raise_for_status()
+        except Exception as err:
+            note = f"Error fetching Patreon membership: [{response.status}] {response.reason}"  # pyright: ignore [reportUnknownMemberType]
+            err.add_note(note)
+            raise
+        else:
+            result = MEMBER_DOCUMENT_DECODER.decode(await response.read())
+            membership = result.data.to_membership()
+            patreon.memberships.put(patreon_user_id, membership)
+            return membership
+
+
+async def get_creator_campaign_id(patreon: PatreonAPI) -> str:
+    """The configured campaign id, or else the first campaign owned by the creator token's account."""
+
+    config = patreon.config
+
+    if config.campaign_id:
+        return config.campaign_id
 
-        async with client.post(PATREON_TOKEN_URL, data=data, headers=headers, auth=PATREON_AUTH) as response:
+    url = f"{config.api_base}/oauth2/v2/campaigns"
+    headers = {
+        "Authorization": f"Bearer {config.creator_access_token}",
+    }
+
+    async with patreon.client.get(url, headers=headers, route="GET /oauth2/v2/campaigns") as response:
+        try:
+            response.raise_for_status()
+        except Exception as err:
+            note = f"Error fetching Patreon campaigns: [{response.status}] {response.reason}"  # pyright: ignore [reportUnknownMemberType]
+            err.add_note(note)
+            raise
+        else:
+            result = _CAMPAIGNS_DECODER.decode(await response.read())
+            if not result.data:
+                msg = (
+                    "The Patreon creator access token's account has no campaigns. Check creator_access_token, or set "
+                    "campaign_id under [patreon] in the config."
+                )
+                raise RuntimeError(msg)
+            return result.data[0].id
+
+
+async def iter_campaign_member_pages(
+    patreon: PatreonAPI,
+    campaign_id: str,
+    *,
+    page_size: int = 500,
+) -> AsyncIterator[PatreonMembersPage]:
+    """Walk every page of a campaign's members using the creator token, following Patreon's pagination cursors.
+
+    Only one page is held in memory at a time.
+    """
+
+    config = patreon.config
+
+    params = {
+        "include": "user,currently_entitled_tiers",
+        "fields[member]": MEMBER_FIELDS,
+        "fields[user]": "social_connections",
+        "page[count]": str(page_size),
+    }
+    headers = {
+        "Authorization": f"Bearer {config.creator_access_token}",
+    }
+
+    while True:
+        url = f"{config.api_base}/oauth2/v2/campaigns/{campaign_id}/members?{urllib.parse.urlencode(params)}"
+        route = "GET /oauth2/v2/campaigns/{campaign.id}/members"
+        async with patreon.client.get(url, headers=headers, route=route) as response:
             try:
                 response.raise_for_status()
             except Exception as err:
-                note = f"Error refreshing access token: [{response.status}] {response.reason}"  # pyright: ignore [reportUnknownMemberType]
+                note = f"Error fetching campaign members: [{response.status}] {response.reason}"  # pyright: ignore [reportUnknownMemberType]
                 err.add_note(note)
                 raise
             else:
-                new_tokens = msgspec.json.decode(await response.read(), type=AccessTokenObject)
-                await store_discord_tokens(user_id, new_tokens)
-                return new_tokens.access_token
+                page = _MEMBERS_PAGE_DECODER.decode(await response.read())
+
+        yield page
+        if (cursor := page.next_cursor) is None:
+            return
+        params["page[cursor]"] = cursor
+
+
+async def ingest_campaign_members(patreon: PatreonAPI, campaign_id: str) -> AsyncIterator[str]:
+    """Upsert every member of a campaign into the membership cache and the stored Patreon links, page by page.
+
+    Yields the ids of Discord users whose metadata may need pushing: those with stored Discord tokens whose
+    membership changed. Callers can start pushing as soon as the first id arrives.
+    """
+
+    async for page in iter_campaign_member_pages(patreon, campaign_id):
+        linked_accounts = page.discord_user_ids()
+        for member in page.data:
+            patreon_user_id = member.patreon_user_id
+            if patreon_user_id is None:
+                continue
+
+            changed = patreon.memberships.put(patreon_user_id, member.to_membership())
+            user_id = linked_accounts.get(patreon_user_id)
+            if user_id is None or await get_discord_tokens(patreon.storage, user_id) is None:
+                continue
 
-    return tokens.access_token
\ No newline at end of file
+            link = PatreonLink(patreon_user_id, member.id)
+            if await get_patreon_link(patreon.storage, user_id) != link:
+                await store_patreon_link(patreon.storage, user_id, link)
+            if changed:
+                yield user_id
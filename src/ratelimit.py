@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from aiohttp import ClientResponse
+
+from .tracing import span
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Resets computed from responses in the same window differ only by how long each took to arrive. One this much later
+# than the bucket's current reset belongs to the next window.
+_RESET_TOLERANCE = 0.2
+
+
+class _Bucket:
+    __slots__ = ("limit", "lock", "remaining", "reset_at")
+
+    def __init__(self) -> None:
+        # asyncio.Lock wakes waiters in FIFO order, so this doubles as the bucket's request queue.
+        self.lock = asyncio.Lock()
+        # Unknown until Discord reports it. Until then, requests on the bucket go one at a time.
+        self.limit: int | None = None
+        self.remaining = 1
+        self.reset_at = 0.0
+
+
+class DiscordRateLimiter:
+    """Tracks Discord's per-route rate limit buckets and the global rate limit.
+
+    Requests are identified by a route key plus a "major" parameter (the user for routes authorized with a user's
+    bearer token). Until Discord reports which bucket a route belongs to, each route key gets its own bucket. After
+    that, routes that share a bucket hash share a queue.
+
+    Until a bucket's limit is known, its requests are sent one at a time. After that, as many may be in flight at once
+    as the bucket has remaining, and only requests beyond that wait for the reset.
+
+    See https://discord.com/developers/docs/topics/rate-limits for details.
+    """
+
+    def __init__(self, *, max_buckets: int = 10_000) -> None:
+        self.max_buckets = max_buckets
+        self._route_to_hash: dict[str, str] = {}
+        self._buckets: dict[str, _Bucket] = {}
+        self._global_reset_at = 0.0
+
+    def _evict_idle_buckets(self) -> None:
+        # Per-user buckets would otherwise accumulate forever during bulk pushes.
+        now = asyncio.get_running_loop().time()
+        idle = [key for key, bucket in self._buckets.items() if not bucket.lock.locked() and bucket.reset_at <= now]
+        for key in idle:
+            del self._buckets[key]
+
+    def _bucket_key(self, route: str, major: str) -> str:
+        return f"{self._route_to_hash.get(route, route)}:{major}"
+
+    def _get_bucket(self, route: str, major: str) -> _Bucket:
+        key = self._bucket_key(route, major)
+        try:
+            return self._buckets[key]
+        except KeyError:
+            if len(self._buckets) >= self.max_buckets:
+                self._evict_idle_buckets()
+            bucket = self._buckets[key] = _Bucket()
+            return bucket
+
+    async def _wait_for_global(self) -> None:
+        loop = asyncio.get_running_loop()
+        while (delay := self._global_reset_at - loop.time()) > 0:
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def acquire(self, route: str, major: str = "") -> AsyncIterator[None]:
+        """Wait until a request on this route may be sent.
+
+        While the bucket's limits are still unknown, it is held until the response has arrived.
+        """
+
+        loop = asyncio.get_running_loop()
+        bucket = self._get_bucket(route, major)
+        await bucket.lock.acquire()
+        held = True
+        try:
+            await self._wait_for_global()
+            if bucket.remaining <= 0 and (delay := bucket.reset_at - loop.time()) > 0:
+                LOGGER.debug("Bucket for %s (%s) is exhausted; waiting %.2fs.", route, major, delay)
+                with span("ratelimit.wait", route=route):
+                    await asyncio.sleep(delay)
+            if bucket.limit is not None:
+                if bucket.reset_at <= loop.time():
+                    bucket.remaining = bucket.limit
+                bucket.remaining -= 1
+                # The bucket's limits are known, so let the next request through without waiting for this response.
+                bucket.lock.release()
+                held = False
+            yield
+        finally:
+            if held:
+                bucket.lock.release()
+
+    def update(self, route: str, major: str, response: ClientResponse) -> None:
+        """Record the rate limit state reported in a response's headers."""
+
+        headers = response.headers
+        bucket_hash = headers.get("X-RateLimit-Bucket")
+        if bucket_hash is not None and self._route_to_hash.get(route) != bucket_hash:
+            old_key = self._bucket_key(route, major)
+            self._route_to_hash[route] = bucket_hash
+            # Carry the bucket the current request holds over to its real key, so queued requests keep their place.
+            if (old_bucket := self._buckets.get(old_key)) is not None:
+                self._buckets.setdefault(self._bucket_key(route, major), old_bucket)
+
+        bucket = self._get_bucket(route, major)
+        if (limit := headers.get("X-RateLimit-Limit")) is not None:
+            bucket.limit = int(limit)
+
+        now = asyncio.get_running_loop().time()
+        reset_at = None
+        if (reset_after := headers.get("X-RateLimit-Reset-After")) is not None:
+            reset_at = now + float(reset_after)
+        # Responses to requests sent together arrive in any order, and each reports what was left when Discord handled
+        # it, so a late one can report slots that are already spent. Within a window, only ever lower the count; take
+        # the reported count as is only once the window has moved on.
+        new_window = reset_at is not None and (bucket.reset_at <= now or reset_at > bucket.reset_at + _RESET_TOLERANCE)
+        if (remaining := headers.get("X-RateLimit-Remaining")) is not None:
+            bucket.remaining = int(remaining) if new_window else min(bucket.remaining, int(remaining))
+        if new_window and reset_at is not None:
+            bucket.reset_at = reset_at
+
+    def set_global_limit(self, retry_after: float) -> None:
+        self._global_reset_at = max(self._global_reset_at, asyncio.get_running_loop().time() + retry_after)
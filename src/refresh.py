@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any, Generic, TypeVar
+
+from .metrics import CallbackMetric
+
+
+T = TypeVar("T")
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SingleFlight(Generic[T]):
+    """Collapses concurrent calls that share a key into one execution.
+
+    The first caller for a key runs the operation. Anyone else who asks for the same key while it is running awaits
+    the same future and gets the same result (or exception) instead of starting their own.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.performed = 0
+        self.coalesced = 0
+        self.failed = 0
+        self._in_flight: dict[str, asyncio.Future[T]] = {}
+        self._reused: set[str] = set()
+        _FLIGHTS.append(self)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def is_running(self, key: str) -> bool:
+        return key in self._in_flight
+
+    def reuse(self, key: str) -> None:
+        """Count the running call for a key as coalesced: it found a result another process already produced."""
+
+        self._reused.add(key)
+
+    async def do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        if (future := self._in_flight.get(key)) is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as err:
+            self.failed += 1
+            future.set_exception(err)
+            # Mark the exception as retrieved; the leader re-raises it and there may be nobody else waiting.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+            # Counted once the call is over, so a call that reused a result is never counted as performed too.
+            if key in self._reused:
+                self._reused.discard(key)
+                self.coalesced += 1
+            else:
+                self.performed += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "performed": self.performed,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "in_flight": self.in_flight,
+        }
+
+
+_FLIGHTS: list[SingleFlight[Any]] = []
+
+
+def _refresh_counts() -> dict[tuple[str, ...], float]:
+    samples: dict[tuple[str, ...], float] = {}
+    for flight in _FLIGHTS:
+        samples[flight.name, "performed"] = flight.performed
+        samples[flight.name, "coalesced"] = flight.coalesced
+        samples[flight.name, "failed"] = flight.failed
+    return samples
+
+
+# These are already counted by each SingleFlight, so they're read at scrape time rather than recorded twice.
+CallbackMetric(
+    "token_refreshes_total",
+    "Token refreshes by provider: performed, coalesced into one already running, and failed.",
+    ("provider", "outcome"),
+    _refresh_counts,
+    type="counter",
+)
+CallbackMetric(
+    "token_refreshes_in_flight",
+    "Token refreshes currently running, by provider.",
+    ("provider",),
+    lambda: {(flight.name,): flight.in_flight for flight in _FLIGHTS},
+)
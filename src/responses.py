@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+from collections.abc import Callable
+from typing import Any
+
+import msgspec
+from aiohttp import web
+
+
+JSON_ENCODER = msgspec.json.Encoder()
+
+# Below this, compressing saves too little to be worth the CPU or the header.
+MIN_COMPRESS_SIZE = 512
+
+
+@functools.cache
+def _compressors() -> dict[str, Callable[[bytes], bytes]]:
+    # Imported on first use; most responses are too small to compress at all.
+    import gzip
+
+    compressors: dict[str, Callable[[bytes], bytes]] = {}
+    try:
+        import brotli  # pyright: ignore [reportMissingImports]
+    except ImportError:
+        pass
+    else:
+        compressors["br"] = brotli.compress  # pyright: ignore [reportUnknownMemberType]
+    compressors["gzip"] = lambda data: gzip.compress(data, compresslevel=6)
+    return compressors
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted: set[str] = set()
+    for item in header.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if q > 0:
+            accepted.add(coding.lower())
+    return accepted
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/ prefixes don't matter.
+    return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(","))
+
+
+class EncodedBody:
+    """A JSON response body, encoded once, with an ETag and compressed variants made the first time they're asked for.
+
+    Build one per distinct body and keep it for as long as the body doesn't change.
+    """
+
+    __slots__ = ("data", "etag", "_compressed")
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.etag = f'"{hashlib.blake2b(data, digest_size=16).hexdigest()}"'
+        self._compressed: dict[str, bytes] = {}
+
+    @classmethod
+    def encode(cls, obj: Any) -> EncodedBody:
+        return cls(JSON_ENCODER.encode(obj))
+
+    def negotiate(self, accept_encoding: str) -> tuple[str | None, bytes]:
+        """Pick the best encoding the client accepts. Returns the encoding (None for none) and the body in it."""
+
+        if len(self.data) < MIN_COMPRESS_SIZE or not accept_encoding:
+            return None, self.data
+
+        accepted = _accepted_encodings(accept_encoding)
+        for coding, compress in _compressors().items():
+            if coding in accepted or "*" in accepted:
+                try:
+                    return coding, self._compressed[coding]
+                except KeyError:
+                    compressed = self._compressed[coding] = compress(self.data)
+                    return coding, compressed
+        return None, self.data
+
+
+def json_response(request: web.Request, body: EncodedBody, *, cache_control: str = "no-cache") -> web.Response:
+    """Respond with a pre-encoded JSON body, honouring If-None-Match and Accept-Encoding."""
+
+    headers = {"ETag": body.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if _etag_matches(request.headers.get("If-None-Match", ""), body.etag):
+        raise web.HTTPNotModified(headers=headers)
+
+    coding, data = body.negotiate(request.headers.get("Accept-Encoding", ""))
+    if coding is not None:
+        headers["Content-Encoding"] = coding
+    return web.Response(body=data, content_type="application/json", headers=headers)
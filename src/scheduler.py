@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import random
+import time
+from collections.abc import AsyncIterable, Awaitable, Callable
+
+from .structs import TokenRecord
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RefreshScheduler:
+    """Refreshes tokens in the background shortly before they expire.
+
+    Expiry times are kept in a min-heap ordered by when each user's refresh is due. Rescheduling a user pushes a new
+    entry and leaves the old one in the heap; stale entries are recognized and skipped when popped.
+
+    A refresh is due `lead_time` seconds before expiry, minus up to `jitter` random seconds so tokens issued together
+    are not all refreshed together. At most `max_concurrency` refreshes run at once.
+    """
+
+    def __init__(
+        self,
+        refresh: Callable[[str], Awaitable[object]],
+        *,
+        lead_time: float = 300,
+        jitter: float = 120,
+        max_concurrency: int = 8,
+    ) -> None:
+        self.refresh = refresh
+        self.lead_time = lead_time
+        self.jitter = jitter
+        self._heap: list[tuple[float, str]] = []
+        self._due: dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: set[asyncio.Task[None]] = set()
+        self._runner: asyncio.Task[None] | None = None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._due
+
+    def schedule(self, user_id: str, tokens: TokenRecord) -> None:
+        """Schedule a refresh for a user's tokens, replacing any earlier schedule for that user."""
+
+        delay = max(tokens.expires_at - time.time() - self.lead_time - random.uniform(0, self.jitter), 0)
+        due = asyncio.get_running_loop().time() + delay
+        self._due[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+        if self._heap[0][1] == user_id:
+            self._wakeup.set()
+
+    def unschedule(self, user_id: str) -> None:
+        self._due.pop(user_id, None)
+
+    async def seed(self, expiring: AsyncIterable[list[tuple[str, TokenRecord]]]) -> int:
+        """Schedule refreshes for stored tokens, such as those that were issued before this process started.
+
+        Users who are already scheduled keep their schedule. Returns how many users were added.
+        """
+
+        added = 0
+        async for batch in expiring:
+            for user_id, tokens in batch:
+                if user_id not in self._due:
+                    self.schedule(user_id, tokens)
+                    added += 1
+        return added
+
+    def start(self) -> None:
+        self._runner = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = self._heap[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            due, user_id = heapq.heappop(self._heap)
+            if self._due.get(user_id) != due:
+                continue
+            del self._due[user_id]
+
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self._refresh(user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, user_id: str) -> None:
+        try:
+            await self.refresh(user_id)
+        except Exception:
+            # The lazy refresh on the request path is still there as a fallback.
+            LOGGER.exception("Background token refresh failed for user %s.", user_id)
+        finally:
+            self._semaphore.release()
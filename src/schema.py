@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import logging
+from typing import Any
+
+from .discord import DiscordAPI, RoleConnAttrType, get_metadata_schema, register_metadata_schema
+from .responses import EncodedBody
+from .structs import SchemaField
+
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_METADATA_SCHEMA = [
+    SchemaField(
+        key="patron",
+        name="Patron",
+        description="Is an active patron",
+        type=RoleConnAttrType.BOOL_EQ,
+    ),
+    SchemaField(
+        key="pledgecents",
+        name="Pledge (cents)",
+        description="Pledges at least this many cents per month",
+        type=RoleConnAttrType.NUM_GREAT_THAN,
+    ),
+    SchemaField(
+        key="patronsince",
+        name="Patron Since",
+        description="Days since becoming a patron",
+        type=RoleConnAttrType.DATETIME_GREAT_THAN,
+    ),
+]
+
+_BOOL_TYPES = {RoleConnAttrType.BOOL_EQ, RoleConnAttrType.BOOL_NEQ}
+_DATETIME_TYPES = {RoleConnAttrType.DATETIME_LESS_THAN, RoleConnAttrType.DATETIME_GREAT_THAN}
+
+
+class SchemaRegistry:
+    """The app's role connection metadata schema, held in memory.
+
+    The schema is declared in config. At startup it is compared against what Discord has registered and only PUT when
+    they differ. After that, reads are served from memory, pre-encoded, with an ETag.
+    """
+
+    def __init__(self, fields: list[SchemaField]) -> None:
+        self.fields = fields
+        self.types = {field.key: field.type for field in fields}
+        self.body = EncodedBody.encode(fields)
+
+    async def reconcile(self, discord: DiscordAPI) -> bool:
+        """Make sure Discord has this schema registered. Returns whether it had to be updated."""
+
+        remote = await get_metadata_schema(discord)
+        if remote == self.fields:
+            LOGGER.info("Registered metadata schema is up to date.")
+            return False
+
+        await register_metadata_schema(discord, self.fields)
+        LOGGER.info("Registered updated metadata schema with %d fields.", len(self.fields))
+        return True
+
+    def validate(self, metadata: dict[str, Any]) -> None:
+        """Check metadata against the schema before it is sent to Discord, which would reject it anyway."""
+
+        for key, value in metadata.items():
+            try:
+                field_type = self.types[key]
+            except KeyError:
+                msg = f"Metadata key {key!r} is not in the registered schema."
+                raise ValueError(msg) from None
+
+            if field_type in _DATETIME_TYPES:
+                valid = isinstance(value, str)
+            elif field_type in _BOOL_TYPES:
+                valid = value in (0, 1)
+            else:
+                valid = isinstance(value, int) and not isinstance(value, bool)
+
+            if not valid:
+                msg = f"Metadata value {value!r} for key {key!r} does not match its schema type {field_type}."
+                raise ValueError(msg)
+
@@ -1,27 +1,58 @@
 from __future__ import annotations
 
+import asyncio
+import hmac
 import logging
+import math
+import time
 from collections.abc import AsyncIterator
 
-from aiohttp import ClientSession, web
+import msgspec
+from aiohttp import web
+from aiohttp.typedefs import Middleware
 
+from .admission import make_admission_middleware
 from .discord import (
+    DISCORD_REFRESHES,
+    DiscordAPI,
     get_cookie_metadata,
-    get_metadata_schema,
+    get_user_data,
     make_discord_token_request,
     prepare_discord_authorization_request,
-    get_user_data,
-    push_metadata,
+    refresh_discord_tokens,
 )
+from .http import CircuitOpenError, HTTPClient, make_client
+from .jobs import JobQueue
+from .metadata import enqueue_push, register_push_jobs
+from .metrics import REGISTRY, metrics_middleware
 from .patreon import (
+    MEMBER_DOCUMENT_DECODER,
+    PatreonAPI,
+    get_patreon_identity,
     make_patreon_token_request,
+    verify_webhook_signature,
 )
-from .storage import get_discord_tokens, store_discord_tokens
-from .verify import random_nonce
+from .ratelimit import DiscordRateLimiter
+from .responses import JSON_ENCODER, json_response
+from .scheduler import RefreshScheduler
+from .schema import DEFAULT_METADATA_SCHEMA, SchemaRegistry
+from .storage import (
+    TokenStorage,
+    get_discord_tokens,
+    get_linked_user_id,
+    make_token_storage,
+    store_discord_tokens,
+    store_patreon_link,
+)
+from .structs import Config, PatreonLink
+from .sync import SyncProgress, bulk_sync
+from .tracing import make_tracing_middleware
+from .verify import STATE_MAX_AGE, derive_state_keys, make_state, verify_state
 
 
 LOGGER = logging.getLogger(__name__)
 
+USER_AGENT = "DiscordBot (https://github.com/Sachaa-Thanasius/patreon-discord-linked-role-auth, 0.0.1)"
 
 routes = web.RouteTableDef()
 
@@ -33,54 +64,112 @@ async def hello(request: web.Request) -> web.Response:
 
 @routes.get("/linked-role")
 async def linked_role(request: web.Request) -> web.Response:
-    state = random_nonce()
-    url = prepare_discord_authorization_request(state)
+    state = make_state(request.app["state_keys"])
+    url = prepare_discord_authorization_request(request.app["config"].discord, state)
     response = web.HTTPSeeOther(location=url)
-    response.set_cookie(name="client_state", value=str(state), max_age=300000, httponly=True)
+    response.set_cookie(name="client_state", value=state, max_age=STATE_MAX_AGE, httponly=True)
     raise response
 
 
+def _unavailable(err: CircuitOpenError) -> web.HTTPServiceUnavailable:
+    # Don't log a traceback for every request turned away during an outage; the breaker logs when it opens.
+    return web.HTTPServiceUnavailable(
+        text=f"{err.upstream.title()} is unavailable right now. Try again shortly.",
+        headers={"Retry-After": str(math.ceil(err.retry_after))},
+    )
+
+
+def _check_state(request: web.Request, state: str) -> None:
+    # The state must be one we issued, and the one issued to this browser.
+    client_state = request.cookies.get("client_state", "")
+    if not (verify_state(state, request.app["state_keys"]) and hmac.compare_digest(state, client_state)):
+        raise web.HTTPForbidden(text="State verification failed.")
+
+
 @routes.get("/patreon/redirect")
 async def patreon_oauth_callback(request: web.Request) -> web.Response:
     try:
         code = request.query["code"]
-        patreon_state = request.query["state"]
-        
-        if not code or not patreon_state:
-            raise web.HTTPForbidden(text="State verification failed.")  # noqa: TRY301
-
-        client_state = request.cookies.get("client_state")
-        if patreon_state != client_state:
-            raise web.HTTPForbidden(text="State verification failed.")  # noqa: TRY301
-
-        tokens = await make_patreon_token_request(request.app["client_session"], code)
-        me_data = await get_user_data(request.app["client_session"], tokens)
-        user_id = me_data.user.id
-        await store_discord_tokens(user_id, tokens)
-        await update_metadata_helper(request.app["client_session"], user_id)
+        _check_state(request, request.query["state"])
+
+        patreon: PatreonAPI = request.app["patreon"]
+        tokens = await make_patreon_token_request(patreon, code)
+        identity = await get_patreon_identity(patreon, tokens)
+        user_id = identity.discord_user_id
+        if user_id is None:
+            raise web.HTTPBadRequest(text="Connect your Discord account to Patreon first.")  # noqa: TRY301
+
+        member = identity.membership_for(patreon.config.campaign_id)
+        await store_patreon_link(patreon.storage, user_id, PatreonLink(identity.data.id, member.id if member else None))
+        if member is not None:
+            # Saves the queued push from fetching it again.
+            patreon.memberships.put(identity.data.id, member.to_membership())
+        await enqueue_push(request.app["job_queue"], user_id)
+    except web.HTTPException:
+        raise
+    except CircuitOpenError as err:
+        raise _unavailable(err) from None
     except Exception:
-        LOGGER.exception("")
+        LOGGER.exception("Patreon OAuth callback failed.")
         raise web.HTTPInternalServerError from None
     else:
         return web.Response(text="You did it! Now go back to Discord.")
 
 
+@routes.post("/patreon/webhook")
+async def patreon_webhook(request: web.Request) -> web.Response:
+    patreon: PatreonAPI = request.app["patreon"]
+    body = await request.read()
+    if not verify_webhook_signature(patreon.config, body, request.headers.get("X-Patreon-Signature", "")):
+        raise web.HTTPForbidden(text="Signature verification failed.")
+
+    try:
+        member = MEMBER_DOCUMENT_DECODER.decode(body).data
+    except msgspec.DecodeError:
+        raise web.HTTPBadRequest from None
+
+    patreon_user_id = member.patreon_user_id
+    if patreon_user_id is None:
+        raise web.HTTPBadRequest
+
+    event = request.headers.get("X-Patreon-Event", "")
+    deleted = event.endswith(":delete")
+    if deleted:
+        patreon.memberships.invalidate(patreon_user_id)
+        changed = True
+    else:
+        changed = patreon.memberships.put(patreon_user_id, member.to_membership())
+
+    if changed and (user_id := await get_linked_user_id(patreon.storage, patreon_user_id)) is not None:
+        # A deleted member can't be fetched again, so drop it from the link and the push sends non-patron metadata.
+        # Otherwise record the member, in case the user linked their account before pledging.
+        await store_patreon_link(patreon.storage, user_id, PatreonLink(patreon_user_id, None if deleted else member.id))
+        # Patreon only waits a few seconds for a response, so leave the push to Discord to the job queue.
+        await enqueue_push(request.app["job_queue"], user_id)
+
+    return web.Response(text="OK")
+
+
 @routes.get("/discord/redirect")
 async def discord_oauth_callback(request: web.Request) -> web.Response:
     try:
         code = request.query["code"]
-        discord_state = request.query["state"]
-        client_state = request.cookies.get("client_state")
-        if discord_state != client_state:
-            raise web.HTTPForbidden(text="State verification failed.")  # noqa: TRY301
+        _check_state(request, request.query["state"])
 
-        tokens = await make_discord_token_request(request.app["client_session"], code)
-        me_data = await get_user_data(request.app["client_session"], tokens)
+        discord: DiscordAPI = request.app["discord"]
+        tokens = await make_discord_token_request(discord, code)
+        me_data = await get_user_data(discord, tokens)
         user_id = me_data.user.id
-        await store_discord_tokens(user_id, tokens)
-        await update_metadata_helper(request.app["client_session"], user_id)
+        # The queued push reads the tokens back from storage, so they have to be stored first.
+        await store_discord_tokens(discord.storage, user_id, tokens)
+        # A fresh authorization may come with an empty role connection, so don't trust the last pushed digest.
+        await enqueue_push(request.app["job_queue"], user_id, force=True)
+    except web.HTTPException:
+        raise
+    except CircuitOpenError as err:
+        raise _unavailable(err) from None
     except Exception:
-        LOGGER.exception("")
+        LOGGER.exception("Discord OAuth callback failed.")
         raise web.HTTPInternalServerError from None
     else:
         return web.Response(text="You did it! Now go back to Discord.")
@@ -88,62 +177,240 @@ async def discord_oauth_callback(request: web.Request) -> web.Response:
 
 @routes.post("/update-metadata")
 async def update_metadata(request: web.Request) -> web.Response:
+    user_id = request.query.get("user_id", "")
+    if not user_id.isdigit():
+        raise web.HTTPBadRequest(text="user_id must be a Discord user id.")
+    force = request.query.get("force", "").lower() in {"1", "true"}
+    if force:
+        # A forced push skips the check for unchanged metadata and spends the rate limit shared with every user.
+        _check_admin(request)
+
     try:
-        user_id = request["user_id"]
-        await update_metadata_helper(request.app["client_session"], user_id)
+        # Repeated calls within the window collapse into the one queued push, keeping `force` if any of them set it.
+        window = request.app["config"].admission.coalesce_window
+        await enqueue_push(request.app["job_queue"], user_id, force=force, delay=window)
     except Exception:
-        LOGGER.exception("")
+        LOGGER.exception("Could not queue a metadata update for user %s.", user_id)
         raise web.HTTPInternalServerError from None
     else:
-        raise web.HTTPNoContent
-
-
-async def update_metadata_helper(client: ClientSession, user_id: str) -> None:
-    tokens = await get_discord_tokens(user_id)
-    assert tokens
-
-    metadata = {}
-    try:
-        metadata = {
-            "cookieseaten": 1483,
-            "allergictonuts": 0,
-            "bakingsince": "2003-12-20",
-        }
-    except Exception as err:
-        err.add_note("Error fetching external data.")
-        LOGGER.exception("")
-
-    await push_metadata(client, user_id, tokens, metadata)
+        raise web.HTTPAccepted
 
 
 @routes.get("/get-metadata")
 async def get_metadata(request: web.Request) -> web.Response:
+    user_id = request.query.get("user_id", "")
+    if not user_id.isdigit():
+        raise web.HTTPBadRequest(text="user_id must be a Discord user id.")
+
     try:
-        user_id = request.query["user_id"]
-        tokens = await get_discord_tokens(user_id)
-        user_cookie_meta = await get_cookie_metadata(request.app["client_session"], user_id, tokens)
+        discord: DiscordAPI = request.app["discord"]
+        tokens = await get_discord_tokens(discord.storage, user_id)
+        if tokens is None:
+            raise web.HTTPNotFound(text="No tokens are stored for this user.")
+        body = await get_cookie_metadata(discord, user_id, tokens)
+    except web.HTTPException:
+        raise
+    except CircuitOpenError as err:
+        raise _unavailable(err) from None
     except Exception:
-        LOGGER.exception("")
+        LOGGER.exception("Could not get metadata for user %s.", user_id)
         raise web.HTTPInternalServerError from None
     else:
-        return web.Response(body=str(user_cookie_meta))
+        return json_response(request, body, cache_control="private, no-cache")
+
+
+@routes.get("/refresh-stats")
+async def refresh_stats(request: web.Request) -> web.Response:
+    stats = {"discord": DISCORD_REFRESHES.stats()}
+    return web.Response(body=JSON_ENCODER.encode(stats), content_type="application/json")
+
+
+@routes.get("/pool-stats")
+async def pool_stats(request: web.Request) -> web.Response:
+    clients: list[HTTPClient] = [request.app["discord"].client, request.app["patreon"].client]
+    stats = {client.name: client.pool.stats() for client in clients if client.pool is not None}
+    return web.Response(body=JSON_ENCODER.encode(stats), content_type="application/json")
 
 
 @routes.get("/get-schema")
 async def get_meta_schema(request: web.Request) -> web.Response:
-    result = await get_metadata_schema(request.app["client_session"])
-    return web.Response(body=str(result))
+    return json_response(request, request.app["schema_registry"].body)
+
+
+@routes.get("/metrics")
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+def _check_admin(request: web.Request) -> None:
+    expected = request.app["config"].admin_token
+    given = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not expected or not hmac.compare_digest(given, expected):
+        raise web.HTTPForbidden
+
+
+@routes.post("/admin/bulk-sync")
+async def start_bulk_sync(request: web.Request) -> web.Response:
+    _check_admin(request)
+    task: asyncio.Task[SyncProgress] | None = request.app.get("bulk_sync_task")
+    if task and not task.done():
+        raise web.HTTPConflict(text="A bulk sync is already running.")
+
+    progress = request.app["bulk_sync_progress"] = SyncProgress()
+    sync = bulk_sync(request.app["job_queue"], request.app["token_storage"], progress=progress)
+    request.app["bulk_sync_task"] = asyncio.create_task(sync)
+    raise web.HTTPAccepted
+
+
+@routes.get("/admin/bulk-sync")
+async def bulk_sync_status(request: web.Request) -> web.Response:
+    _check_admin(request)
+    progress: SyncProgress | None = request.app.get("bulk_sync_progress")
+    if progress is None:
+        raise web.HTTPNotFound(text="No bulk sync has been started.")
+
+    body = JSON_ENCODER.encode({**msgspec.structs.asdict(progress), "rate": progress.rate})
+    return web.Response(body=body, content_type="application/json")
+
+
+@routes.get("/admin/jobs")
+async def job_queue_status(request: web.Request) -> web.Response:
+    _check_admin(request)
+    queue: JobQueue = request.app["job_queue"]
+    body = JSON_ENCODER.encode({**await queue.stats(), "dead_letters": await queue.dead_letters()})
+    return web.Response(body=body, content_type="application/json")
+
+
+@routes.post("/admin/jobs/requeue-dead")
+async def requeue_dead_jobs(request: web.Request) -> web.Response:
+    _check_admin(request)
+    count = await request.app["job_queue"].requeue_dead_letters()
+    return web.Response(body=JSON_ENCODER.encode({"requeued": count}), content_type="application/json")
 
 
 async def client_session_ctx(app: web.Application) -> AsyncIterator[None]:
-    user_agent = f"DiscordBot (https://github.com/Sachaa-Thanasius/patreon-discord-linked-role-auth, 0.0.1)"
-    session = app["client_session"] = ClientSession(headers={"User-Agent": user_agent})
+    # Each upstream gets its own session, so a slow Patreon can't use up the connections Discord calls need.
+    config: Config = app["config"]
+    storage: TokenStorage = app["token_storage"]
+    headers = {"User-Agent": USER_AGENT}
+    discord_client = make_client("discord", config.discord.http, headers=headers, ratelimiter=DiscordRateLimiter())
+    patreon_client = make_client("patreon", config.patreon.http, headers=headers)
+    app["discord"] = DiscordAPI(discord_client, config.discord, storage)
+    app["patreon"] = PatreonAPI(patreon_client, config.patreon, storage)
     yield
-    await session.close()
+    await asyncio.gather(discord_client.close(), patreon_client.close())
 
 
-def make_app() -> web.Application:
-    app = web.Application()
+async def token_storage_ctx(app: web.Application) -> AsyncIterator[None]:
+    storage = app["token_storage"] = make_token_storage(app["config"])
+    await storage.start()
+    yield
+    await storage.close()
+
+
+async def refresh_scheduler_ctx(app: web.Application) -> AsyncIterator[None]:
+    config: Config = app["config"]
+    if not config.refresh.enabled:
+        yield
+        return
+
+    discord: DiscordAPI = app["discord"]
+    storage: TokenStorage = app["token_storage"]
+
+    async def refresh(user_id: str) -> None:
+        # Another worker sharing the store may have refreshed these tokens since they were scheduled, so read past the
+        # cache and leave them alone if they're no longer due; the seeder schedules them again by their new expiry.
+        tokens = await get_discord_tokens(storage, user_id, use_cache=False)
+        if tokens is not None and tokens.expires_within(math.ceil(config.refresh.lead_time + config.refresh.jitter)):
+            await refresh_discord_tokens(discord, user_id, tokens)
+
+    scheduler = app["refresh_scheduler"] = RefreshScheduler(
+        refresh,
+        lead_time=config.refresh.lead_time,
+        jitter=config.refresh.jitter,
+        max_concurrency=config.refresh.max_concurrency,
+    )
+    storage.add_listener(scheduler.schedule)
+    scheduler.start()
+
+    async def seed() -> None:
+        # Tokens issued before this process started aren't in the scheduler. Every `lead_time` seconds, pick up those
+        # whose refresh could come due before the next scan; the expiry index makes each scan a short range read.
+        interval = config.refresh.lead_time
+        while True:
+            horizon = int(time.time() + interval + config.refresh.lead_time + config.refresh.jitter)
+            try:
+                added = await scheduler.seed(storage.iter_expiring(horizon))
+            except Exception:
+                LOGGER.exception("Could not read expiring tokens for the refresh scheduler.")
+            else:
+                if added:
+                    LOGGER.info("Scheduled %d stored tokens for refresh.", added)
+            await asyncio.sleep(interval)
+
+    seeder = asyncio.create_task(seed())
+    yield
+    seeder.cancel()
+    await asyncio.gather(seeder, return_exceptions=True)
+    storage.remove_listener(scheduler.schedule)
+    await scheduler.close()
+
+
+async def schema_ctx(app: web.Application) -> AsyncIterator[None]:
+    try:
+        await app["schema_registry"].reconcile(app["discord"])
+    except Exception:
+        # Discord being unreachable shouldn't stop the app from starting. The local schema is still served and used
+        # for validation; it'll be reconciled on the next start.
+        LOGGER.exception("Could not reconcile the metadata schema with Discord.")
+    yield
+
+
+async def job_queue_ctx(app: web.Application) -> AsyncIterator[None]:
+    config: Config = app["config"]
+    queue = app["job_queue"] = JobQueue(
+        config.jobs.path,
+        workers=config.jobs.workers,
+        max_attempts=config.jobs.max_attempts,
+        backoff_base=config.jobs.backoff_base,
+        backoff_max=config.jobs.backoff_max,
+        tracing=config.tracing,
+    )
+    register_push_jobs(queue, app["discord"], app["patreon"], app["schema_registry"])
+    await queue.start()
+    yield
+    await queue.close()
+
+
+async def bulk_sync_ctx(app: web.Application) -> AsyncIterator[None]:
+    yield
+    task: asyncio.Task[SyncProgress] | None = app.get("bulk_sync_task")
+    if task and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def make_app(config: Config) -> web.Application:
+    """Build the application for a config. Storage, upstream clients and background workers start with the app.
+
+    Everything that depends on the config hangs off the app, so apps built from different configs don't interfere.
+    """
+
+    middlewares: list[Middleware] = [make_tracing_middleware(config.tracing), metrics_middleware]
+    if config.admission.enabled:
+        middlewares.append(make_admission_middleware(config.admission))
+    app = web.Application(middlewares=middlewares)
+    app["config"] = config
+    app["state_keys"] = derive_state_keys([config.cookie_secret, *config.previous_cookie_secrets])
+    app["schema_registry"] = SchemaRegistry(config.discord.metadata_schema or DEFAULT_METADATA_SCHEMA)
     app.add_routes(routes)
+    app.cleanup_ctx.append(token_storage_ctx)
     app.cleanup_ctx.append(client_session_ctx)
+    app.cleanup_ctx.append(schema_ctx)
+    app.cleanup_ctx.append(refresh_scheduler_ctx)
+    app.cleanup_ctx.append(job_queue_ctx)
+    app.cleanup_ctx.append(bulk_sync_ctx)
     return app
@@ -1,27 +1,734 @@
 from __future__ import annotations
 
+import abc
 import asyncio
+import bisect
 import logging
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, TypeVar
 
-from .structs import AccessTokenObject
+import msgspec
 
+from .crypto import TokenCipher, is_sealed
+from .metrics import STORAGE_OPERATION_DURATION
+from .structs import AccessTokenObject, Config, PatreonLink, TokenRecord
+from .tracing import span
+
+
+if TYPE_CHECKING:
+    import sqlite3
+
+T = TypeVar("T")
 
 LOGGER = logging.getLogger(__name__)
 
-TOKEN_STORE: dict[str, AccessTokenObject] = {}
+_TOKEN_ENCODER = msgspec.msgpack.Encoder()
+_TOKEN_DECODER = msgspec.msgpack.Decoder(TokenRecord)
+# Rows from before token records had an expiry; see SQLiteTokenStorage._migrate.
+_LEGACY_TOKEN_DECODER = msgspec.msgpack.Decoder(AccessTokenObject)
+
+# Sealing or opening fewer records than this is quicker inline than handing them to another thread.
+_CRYPTO_OFFLOAD_THRESHOLD = 32
+
+
+class ShardedLockTable:
+    """A fixed table of locks that user ids hash into.
+
+    Writers for different users almost never share a lock, and the table never grows no matter how many users there
+    are. The shard count must be a power of two.
+    """
+
+    def __init__(self, shards: int = 256) -> None:
+        assert shards > 0 and (shards & (shards - 1)) == 0
+        self._mask = shards - 1
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+
+    def get(self, key: str) -> asyncio.Lock:
+        return self._locks[hash(key) & self._mask]
+
+
+class TokenStorage(abc.ABC):
+    """The interface every token storage backend implements.
+
+    Reads never take a lock. Writes are serialized per user through a sharded lock table, so writes for different
+    users proceed concurrently.
+    """
+
+    def __init__(self) -> None:
+        self._write_locks = ShardedLockTable()
+        self._lease_locks = ShardedLockTable()
+        self._listeners: list[Callable[[str, TokenRecord], None]] = []
+
+    def add_listener(self, listener: Callable[[str, TokenRecord], None]) -> None:
+        """Register a callback that is run synchronously after every successful store."""
+
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[str, TokenRecord], None]) -> None:
+        self._listeners.remove(listener)
+
+    async def start(self) -> None:  # noqa: B027
+        """Open any resources the backend needs. Called once before first use. A no-op for backends that need none."""
+
+    async def close(self) -> None:  # noqa: B027
+        """Flush pending writes and release resources. A no-op for backends that hold none."""
+
+    async def store(self, user_id: str, tokens: TokenRecord) -> None:
+        async with self._write_locks.get(user_id):
+            await self._store(user_id, tokens)
+        for listener in self._listeners:
+            listener(user_id, tokens)
+
+    async def delete(self, user_id: str) -> None:
+        async with self._write_locks.get(user_id):
+            await self._delete(user_id)
+
+    @abc.abstractmethod
+    async def _store(self, user_id: str, tokens: TokenRecord) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def _delete(self, user_id: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def get(self, user_id: str, *, use_cache: bool = True) -> TokenRecord | None:
+        """Get a user's tokens. `use_cache=False` skips any in-process cache that could be stale across processes."""
+
+    @asynccontextmanager
+    async def lease(self, key: str, ttl: float = 30) -> AsyncIterator[None]:
+        """Hold an exclusive lease on a key for the duration of the block.
+
+        This only excludes other tasks in this process. Backends that can be shared between processes extend it to
+        exclude other processes as well.
+        """
+
+        async with self._lease_locks.get(key):
+            yield
+
+    @abc.abstractmethod
+    async def store_patreon_link(self, user_id: str, link: PatreonLink) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def get_patreon_link(self, user_id: str) -> PatreonLink | None:
+        ...
+
+    @abc.abstractmethod
+    async def get_linked_user_id(self, patreon_user_id: str) -> str | None:
+        """Find the Discord user that linked the given Patreon user."""
+
+    @abc.abstractmethod
+    async def get_metadata_digest(self, user_id: str) -> bytes | None:
+        """Get the digest of the metadata last pushed to Discord for a user."""
+
+    @abc.abstractmethod
+    async def store_metadata_digest(self, user_id: str, digest: bytes) -> None:
+        ...
+
+    @abc.abstractmethod
+    def iter_user_ids(self, after: str | None = None, batch_size: int = 1000) -> AsyncIterator[list[str]]:
+        """Yield batches of stored user ids in ascending numeric order, starting after the given id."""
+
+    @abc.abstractmethod
+    def iter_expiring(self, before: int, batch_size: int = 1000) -> AsyncIterator[list[tuple[str, TokenRecord]]]:
+        """Yield batches of users whose tokens expire before a Unix timestamp, soonest first."""
+
+
+class MemoryTokenStorage(TokenStorage):
+    """Process-local storage. Everything is lost on restart."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._tokens: dict[int, TokenRecord] = {}
+        self._links: dict[str, PatreonLink] = {}
+        self._reverse_links: dict[str, str] = {}
+        self._metadata_digests: dict[str, bytes] = {}
+
+    async def _store(self, user_id: str, tokens: TokenRecord) -> None:
+        self._tokens[int(user_id)] = tokens
+
+    async def _delete(self, user_id: str) -> None:
+        self._tokens.pop(int(user_id), None)
+
+    async def get(self, user_id: str, *, use_cache: bool = True) -> TokenRecord | None:
+        return self._tokens.get(int(user_id))
+
+    async def store_patreon_link(self, user_id: str, link: PatreonLink) -> None:
+        if (old := self._links.get(user_id)) is not None:
+            self._reverse_links.pop(old.patreon_user_id, None)
+        # A Patreon account can only be linked to one Discord user at a time.
+        if (previous_user_id := self._reverse_links.get(link.patreon_user_id)) is not None:
+            self._links.pop(previous_user_id, None)
+        self._links[user_id] = link
+        self._reverse_links[link.patreon_user_id] = user_id
+
+    async def get_patreon_link(self, user_id: str) -> PatreonLink | None:
+        return self._links.get(user_id)
+
+    async def get_linked_user_id(self, patreon_user_id: str) -> str | None:
+        return self._reverse_links.get(patreon_user_id)
+
+    async def get_metadata_digest(self, user_id: str) -> bytes | None:
+        return self._metadata_digests.get(user_id)
+
+    async def store_metadata_digest(self, user_id: str, digest: bytes) -> None:
+        self._metadata_digests[user_id] = digest
+
+    async def iter_user_ids(self, after: str | None = None, batch_size: int = 1000) -> AsyncIterator[list[str]]:
+        user_ids = sorted(self._tokens)
+        start = bisect.bisect_right(user_ids, int(after)) if after is not None else 0
+        for i in range(start, len(user_ids), batch_size):
+            yield [str(user_id) for user_id in user_ids[i : i + batch_size]]
+
+    async def iter_expiring(self, before: int, batch_size: int = 1000) -> AsyncIterator[list[tuple[str, TokenRecord]]]:
+        # Sorted on demand; this backend is for development, where there are never many users.
+        expiring = sorted(
+            (tokens.expires_at, user_id) for user_id, tokens in self._tokens.items() if tokens.expires_at < before
+        )
+        for i in range(0, len(expiring), batch_size):
+            yield [(str(user_id), self._tokens[user_id]) for _, user_id in expiring[i : i + batch_size]]
+
+
+class _LRUCache:
+    """A minimal LRU mapping used as the in-process front cache for persistent backends.
+
+    Entries can optionally expire, which bounds how stale they get when other processes write to the same backend.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[int, tuple[float, TokenRecord]] = OrderedDict()
+
+    def get(self, key: int) -> TokenRecord | None:
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return None
+
+        stored_at, value = self._data[key]
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            return None
+        return value
+
+    def put(self, key: int, value: TokenRecord) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: int) -> None:
+        self._data.pop(key, None)
+
+
+class SQLiteTokenStorage(TokenStorage):
+    """Persistent storage backed by a SQLite database in WAL mode.
+
+    All blocking calls run on a dedicated single-thread executor, so the event loop never waits on disk and the
+    connection is only ever touched from one thread. Writes are grouped into batches that are committed together, and
+    reads are served from an in-process LRU cache when possible.
+
+    With a cipher, tokens are sealed before they're written. Batches are sealed and opened on a separate thread pool,
+    so neither the event loop nor the database thread spends its time on crypto. Rows written in plaintext, or sealed
+    with a key that has since been rotated out, are rewritten with the current key when they're next read.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        cache_size: int = 10_000,
+        cache_ttl: float | None = None,
+        batch_size: int = 500,
+        flush_interval: float = 0.01,
+        cipher: TokenCipher | None = None,
+        crypto_threads: int = 2,
+    ) -> None:
+        super().__init__()
+        self.path = path
+        self.cipher = cipher
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._cache = _LRUCache(cache_size, cache_ttl)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="token-storage")
+        self._conn: sqlite3.Connection | None = None
+        self._pending: dict[int, tuple[int, bytes]] = {}
+        self._pending_waiters: list[asyncio.Future[None]] = []
+        # Rows to bring up to the current key: user id -> (blob as read, replacement).
+        self._rewrites: dict[int, tuple[bytes, bytes]] = {}
+        self._crypto_executor = (
+            ThreadPoolExecutor(max_workers=crypto_threads, thread_name_prefix="token-crypto") if cipher else None
+        )
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task: asyncio.Task[None] | None = None
+        self._closed = False
+        # Bumped on every write so lock-free reads can tell whether the row they fetched is already stale.
+        self._write_generation = 0
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _run_crypto(self, func: Callable[[], T], size: int) -> T:
+        if self._crypto_executor is None or size < _CRYPTO_OFFLOAD_THRESHOLD:
+            return func()
+        return await asyncio.get_running_loop().run_in_executor(self._crypto_executor, func)
+
+    def _seal_batch(self, batch: list[tuple[int, int, bytes]]) -> list[tuple[int, int, bytes]]:
+        cipher = self.cipher
+        if cipher is None:
+            return batch
+        return [(user_id, expires_at, cipher.seal(_owner(user_id), raw)) for user_id, expires_at, raw in batch]
+
+    def _open_rows(self, rows: list[tuple[int, bytes]]) -> list[tuple[bytes, bytes | None]]:
+        """Get the plaintext of stored rows, and for each the blob it should be replaced with, if any."""
 
-store_lock = asyncio.Lock()
+        cipher = self.cipher
+        opened: list[tuple[bytes, bytes | None]] = []
+        for user_id, blob in rows:
+            if not is_sealed(blob):
+                opened.append((blob, cipher.seal(_owner(user_id), blob) if cipher else None))
+                continue
+            if cipher is None:
+                msg = f"The stored tokens for user {user_id} are encrypted, but no encryption keys are configured."
+                raise RuntimeError(msg)
+            try:
+                plaintext = cipher.open(_owner(user_id), blob)
+            except Exception as err:
+                err.add_note(f"Could not decrypt the stored tokens for user {user_id}.")
+                raise
+            opened.append((plaintext, cipher.rewrap(_owner(user_id), blob) if cipher.needs_rewrap(blob) else None))
+        return opened
 
+    async def _open_blobs(self, rows: list[tuple[int, bytes]]) -> list[bytes]:
+        opened = await self._run_crypto(lambda: self._open_rows(rows), len(rows))
+        for (user_id, blob), (_, replacement) in zip(rows, opened, strict=True):
+            if replacement is not None:
+                self._rewrites[user_id] = (blob, replacement)
+                self._flush_wakeup.set()
+        return [plaintext for plaintext, _ in opened]
 
-async def store_discord_tokens(user_id: str, tokens: AccessTokenObject) -> None:
-    LOGGER.debug("Storing token: user_id=%s, tokens=%s", user_id, tokens)
-    async with store_lock:
-        TOKEN_STORE[f"discord-{user_id}"] = tokens
+    def _open(self) -> None:
+        # Imported here so the memory backend never pays for it.
+        import sqlite3
 
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Other worker processes may hold the write lock briefly; wait for them rather than failing.
+        conn.execute("PRAGMA busy_timeout=5000")
+        # User ids are Discord snowflakes, which fit in SQLite's 64-bit integers, so they can be the rowid itself.
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_records "
+            "(user_id INTEGER PRIMARY KEY, expires_at INTEGER NOT NULL, tokens BLOB NOT NULL)",
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS token_records_expires_at ON token_records (expires_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS patreon_links "
+            "(user_id TEXT PRIMARY KEY, patreon_user_id TEXT NOT NULL UNIQUE, member_id TEXT) WITHOUT ROWID",
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata_digests "
+            "(user_id TEXT PRIMARY KEY, digest BLOB NOT NULL) WITHOUT ROWID",
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL) "
+            "WITHOUT ROWID",
+        )
+        conn.commit()
+        self._migrate(conn)
+        self._conn = conn
 
-async def get_discord_tokens(user_id: str) -> AccessTokenObject | None:
-    LOGGER.debug("Getting token: user_id=%s", user_id)
-    async with store_lock:
-        tokens = TOKEN_STORE.get(f"discord-{user_id}", None)
-        LOGGER.debug("Gotten token: %s", tokens)
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        """Move tokens out of the old discord_tokens table, if there is one, into token_records.
+
+        The old rows never had an expiry. They're given one in the past, so they're refreshed the next time they're
+        used and the refresh scheduler picks them up straight away.
+        """
+
+        query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'discord_tokens'"
+        if conn.execute(query).fetchone() is None:
+            return
+
+        with conn:
+            rows: list[tuple[int, int, bytes]] = []
+            for user_id, raw in conn.execute("SELECT user_id, tokens FROM discord_tokens"):
+                legacy = _LEGACY_TOKEN_DECODER.decode(raw)
+                tokens = TokenRecord(legacy.access_token, legacy.refresh_token, 0)
+                rows.append((int(user_id), tokens.expires_at, _TOKEN_ENCODER.encode(tokens)))
+            conn.executemany(
+                "INSERT OR IGNORE INTO token_records (user_id, expires_at, tokens) VALUES (?, ?, ?)",
+                rows,
+            )
+            conn.execute("DROP TABLE discord_tokens")
+        LOGGER.info("Migrated %d token records from the discord_tokens table.", len(rows))
+
+    def _write_batch(self, batch: list[tuple[int, int, bytes]]) -> None:
+        assert self._conn
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO token_records (user_id, expires_at, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET expires_at = excluded.expires_at, tokens = excluded.tokens",
+                batch,
+            )
+
+    def _delete_row(self, user_id: int) -> None:
+        assert self._conn
+        with self._conn:
+            self._conn.execute("DELETE FROM token_records WHERE user_id = ?", (user_id,))
+
+    def _write_link(self, user_id: str, link: PatreonLink) -> None:
+        assert self._conn
+        with self._conn:
+            # A Patreon account can only be linked to one Discord user at a time.
+            self._conn.execute("DELETE FROM patreon_links WHERE patreon_user_id = ?", (link.patreon_user_id,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO patreon_links (user_id, patreon_user_id, member_id) VALUES (?, ?, ?)",
+                (user_id, link.patreon_user_id, link.member_id),
+            )
+
+    def _read_link(self, user_id: str) -> PatreonLink | None:
+        assert self._conn
+        query = "SELECT patreon_user_id, member_id FROM patreon_links WHERE user_id = ?"
+        row = self._conn.execute(query, (user_id,)).fetchone()
+        return PatreonLink(*row) if row else None
+
+    def _read_linked_user_id(self, patreon_user_id: str) -> str | None:
+        assert self._conn
+        query = "SELECT user_id FROM patreon_links WHERE patreon_user_id = ?"
+        row = self._conn.execute(query, (patreon_user_id,)).fetchone()
+        return row[0] if row else None
+
+    def _try_acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        assert self._conn
+        now = time.time()
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.expires_at < ?",
+                (key, owner, now + ttl, now),
+            )
+            return cursor.rowcount == 1
+
+    def _renew_lease(self, key: str, owner: str, ttl: float) -> bool:
+        assert self._conn
+        with self._conn:
+            cursor = self._conn.execute(
+                "UPDATE leases SET expires_at = ? WHERE key = ? AND owner = ?",
+                (time.time() + ttl, key, owner),
+            )
+            return cursor.rowcount == 1
+
+    def _release_lease(self, key: str, owner: str) -> None:
+        assert self._conn
+        with self._conn:
+            self._conn.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+    def _read_metadata_digest(self, user_id: str) -> bytes | None:
+        assert self._conn
+        row = self._conn.execute("SELECT digest FROM metadata_digests WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def _write_metadata_digest(self, user_id: str, digest: bytes) -> None:
+        assert self._conn
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metadata_digests (user_id, digest) VALUES (?, ?)",
+                (user_id, digest),
+            )
+
+    def _read_user_ids(self, after: int, limit: int) -> list[int]:
+        assert self._conn
+        query = "SELECT user_id FROM token_records WHERE user_id > ? ORDER BY user_id LIMIT ?"
+        return [row[0] for row in self._conn.execute(query, (after, limit))]
+
+    def _rewrite_rows(self, rows: list[tuple[bytes, int, bytes]]) -> None:
+        assert self._conn
+        with self._conn:
+            # Only if the row hasn't been written since it was read, here or by another process.
+            self._conn.executemany("UPDATE token_records SET tokens = ? WHERE user_id = ? AND tokens = ?", rows)
+
+    def _read_expiring(self, before: int, after: tuple[int, int], limit: int) -> list[tuple[int, int, bytes]]:
+        assert self._conn
+        # A range scan over the expiry index. (expires_at, user_id) is unique, so it works as a pagination cursor.
+        query = (
+            "SELECT expires_at, user_id, tokens FROM token_records "
+            "WHERE expires_at < ? AND (expires_at, user_id) > (?, ?) ORDER BY expires_at, user_id LIMIT ?"
+        )
+        return self._conn.execute(query, (before, *after, limit)).fetchall()
+
+    def _read(self, user_id: int) -> bytes | None:
+        assert self._conn
+        row = self._conn.execute("SELECT tokens FROM token_records WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    async def start(self) -> None:
+        await self._run(self._open)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        LOGGER.info("Opened SQLite token storage at %s", self.path)
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._flush_task:
+            self._flush_wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+        await self._flush()
+        if self._conn:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+        if self._crypto_executor:
+            self._crypto_executor.shutdown(wait=True)
+
+    async def _flush_loop(self) -> None:
+        while not self._closed:
+            await self._flush_wakeup.wait()
+            # Give concurrent writers a moment to join the batch.
+            if not self._closed and len(self._pending) < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            self._flush_wakeup.clear()
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if self._rewrites:
+            rewrites = [(new, user_id, old) for user_id, (old, new) in self._rewrites.items()]
+            self._rewrites = {}
+            try:
+                await self._run(self._rewrite_rows, rewrites)
+            except Exception:
+                # They'll be tried again the next time the rows are read.
+                LOGGER.exception("Failed to rewrite %d token records with the current key.", len(rewrites))
+
+        if not self._pending:
+            return
+
+        batch = [(user_id, expires_at, raw) for user_id, (expires_at, raw) in self._pending.items()]
+        self._pending = {}
+        waiters, self._pending_waiters = self._pending_waiters, []
+        try:
+            batch = await self._run_crypto(lambda: self._seal_batch(batch), len(batch))
+            await self._run(self._write_batch, batch)
+        except Exception as err:
+            LOGGER.exception("Failed to write a batch of %d token records.", len(batch))
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(err)
+        else:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def _store(self, user_id: str, tokens: TokenRecord) -> None:
+        key = int(user_id)
+        self._write_generation += 1
+        # Reads see the pending write until it's flushed. Only cache it once it's committed, so a failed write never
+        # leaves the cache serving tokens that aren't in the database.
+        self._cache.pop(key)
+        self._pending[key] = (tokens.expires_at, _TOKEN_ENCODER.encode(tokens))
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._pending_waiters.append(waiter)
+        self._flush_wakeup.set()
+        await waiter
+        # Stops a read that raced the flush from caching the row as it was before.
+        self._write_generation += 1
+        self._cache.put(key, tokens)
+
+    async def _delete(self, user_id: str) -> None:
+        # A store for this user holds the write lock until its batch is written, so nothing for them is pending here.
+        key = int(user_id)
+        self._write_generation += 1
+        self._cache.pop(key)
+        self._rewrites.pop(key, None)
+        await self._run(self._delete_row, key)
+
+    @asynccontextmanager
+    async def lease(self, key: str, ttl: float = 30, poll_interval: float = 0.05) -> AsyncIterator[None]:
+        """Hold a lease that is exclusive across every process using this database.
+
+        The lease is a row in the leases table. It's renewed every `ttl / 3` seconds for as long as the block runs, so
+        a block may take longer than `ttl`; if its holder dies, it can be taken over once `ttl` has passed.
+        """
+
+        owner = uuid.uuid4().hex
+        async with super().lease(key, ttl):
+            while not await self._run(self._try_acquire_lease, key, owner, ttl):
+                await asyncio.sleep(poll_interval)
+            renewer = asyncio.create_task(self._keep_lease(key, owner, ttl))
+            try:
+                yield
+            finally:
+                renewer.cancel()
+                await asyncio.gather(renewer, return_exceptions=True)
+                await self._run(self._release_lease, key, owner)
+
+    async def _keep_lease(self, key: str, owner: str, ttl: float) -> None:
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                renewed = await self._run(self._renew_lease, key, owner, ttl)
+            except Exception:
+                LOGGER.exception("Could not renew the lease on %s.", key)
+                continue
+            if not renewed:
+                LOGGER.warning("Lost the lease on %s; another process may now hold it.", key)
+                return
+
+    async def get(self, user_id: str, *, use_cache: bool = True) -> TokenRecord | None:
+        key = int(user_id)
+        if use_cache and (tokens := self._cache.get(key)) is not None:
+            return tokens
+
+        if (pending := self._pending.get(key)) is not None:
+            return _TOKEN_DECODER.decode(pending[1])
+
+        generation = self._write_generation
+        raw = await self._run(self._read, key)
+        if raw is None:
+            return None
+
+        [plaintext] = await self._open_blobs([(key, raw)])
+        tokens = _TOKEN_DECODER.decode(plaintext)
+        if generation == self._write_generation:
+            self._cache.put(key, tokens)
         return tokens
+
+    async def store_patreon_link(self, user_id: str, link: PatreonLink) -> None:
+        await self._run(self._write_link, user_id, link)
+
+    async def get_patreon_link(self, user_id: str) -> PatreonLink | None:
+        return await self._run(self._read_link, user_id)
+
+    async def get_linked_user_id(self, patreon_user_id: str) -> str | None:
+        return await self._run(self._read_linked_user_id, patreon_user_id)
+
+    async def get_metadata_digest(self, user_id: str) -> bytes | None:
+        return await self._run(self._read_metadata_digest, user_id)
+
+    async def store_metadata_digest(self, user_id: str, digest: bytes) -> None:
+        await self._run(self._write_metadata_digest, user_id, digest)
+
+    async def iter_user_ids(self, after: str | None = None, batch_size: int = 1000) -> AsyncIterator[list[str]]:
+        # Keyset pagination over the primary key, so each batch is an index range scan no matter how far in we are.
+        cursor = int(after) if after is not None else -1
+        while batch := await self._run(self._read_user_ids, cursor, batch_size):
+            yield [str(user_id) for user_id in batch]
+            cursor = batch[-1]
+
+    async def iter_expiring(self, before: int, batch_size: int = 1000) -> AsyncIterator[list[tuple[str, TokenRecord]]]:
+        cursor = (-1, -1)
+        while rows := await self._run(self._read_expiring, before, cursor, batch_size):
+            plaintexts = await self._open_blobs([(user_id, raw) for _, user_id, raw in rows])
+            yield [
+                (str(user_id), _TOKEN_DECODER.decode(plaintext))
+                for (_, user_id, _), plaintext in zip(rows, plaintexts, strict=True)
+            ]
+            cursor = rows[-1][0], rows[-1][1]
+
+
+def _owner(user_id: int) -> bytes:
+    return user_id.to_bytes(8, "big")
+
+
+def make_token_storage(config: Config) -> TokenStorage:
+    if config.storage.backend == "sqlite":
+        cipher = TokenCipher(config.storage.encryption_keys) if config.storage.encryption_keys else None
+        return SQLiteTokenStorage(
+            config.storage.path,
+            cache_size=config.storage.cache_size,
+            cache_ttl=config.storage.cache_ttl,
+            cipher=cipher,
+            crypto_threads=config.storage.crypto_threads,
+        )
+    return MemoryTokenStorage()
+
+
+_STORE_TOKENS_TIME = STORAGE_OPERATION_DURATION.labels("store_tokens")
+_GET_TOKENS_TIME = STORAGE_OPERATION_DURATION.labels("get_tokens")
+_STORE_LINK_TIME = STORAGE_OPERATION_DURATION.labels("store_patreon_link")
+_GET_LINK_TIME = STORAGE_OPERATION_DURATION.labels("get_patreon_link")
+_GET_LINKED_USER_TIME = STORAGE_OPERATION_DURATION.labels("get_linked_user_id")
+_GET_DIGEST_TIME = STORAGE_OPERATION_DURATION.labels("get_metadata_digest")
+_STORE_DIGEST_TIME = STORAGE_OPERATION_DURATION.labels("store_metadata_digest")
+
+
+async def store_discord_tokens(storage: TokenStorage, user_id: str, tokens: TokenRecord) -> None:
+    LOGGER.debug("Storing tokens for user %s.", user_id)
+    with span("storage.store_tokens"):
+        start = time.perf_counter()
+        try:
+            await storage.store(user_id, tokens)
+        finally:
+            _STORE_TOKENS_TIME.observe(time.perf_counter() - start)
+
+
+async def get_discord_tokens(storage: TokenStorage, user_id: str, *, use_cache: bool = True) -> TokenRecord | None:
+    with span("storage.get_tokens"):
+        start = time.perf_counter()
+        try:
+            return await storage.get(user_id, use_cache=use_cache)
+        finally:
+            _GET_TOKENS_TIME.observe(time.perf_counter() - start)
+
+
+async def delete_discord_tokens(storage: TokenStorage, user_id: str) -> None:
+    LOGGER.debug("Deleting tokens for user %s.", user_id)
+    with span("storage.delete_tokens"):
+        await storage.delete(user_id)
+
+
+async def store_patreon_link(storage: TokenStorage, user_id: str, link: PatreonLink) -> None:
+    LOGGER.debug("Storing Patreon link: user_id=%s, link=%s", user_id, link)
+    with span("storage.store_patreon_link"):
+        start = time.perf_counter()
+        try:
+            await storage.store_patreon_link(user_id, link)
+        finally:
+            _STORE_LINK_TIME.observe(time.perf_counter() - start)
+
+
+async def get_patreon_link(storage: TokenStorage, user_id: str) -> PatreonLink | None:
+    with span("storage.get_patreon_link"):
+        start = time.perf_counter()
+        try:
+            return await storage.get_patreon_link(user_id)
+        finally:
+            _GET_LINK_TIME.observe(time.perf_counter() - start)
+
+
+async def get_linked_user_id(storage: TokenStorage, patreon_user_id: str) -> str | None:
+    with span("storage.get_linked_user_id"):
+        start = time.perf_counter()
+        try:
+            return await storage.get_linked_user_id(patreon_user_id)
+        finally:
+            _GET_LINKED_USER_TIME.observe(time.perf_counter() - start)
+
+
+async def get_metadata_digest(storage: TokenStorage, user_id: str) -> bytes | None:
+    with span("storage.get_metadata_digest"):
+        start = time.perf_counter()
+        try:
+            return await storage.get_metadata_digest(user_id)
+        finally:
+            _GET_DIGEST_TIME.observe(time.perf_counter() - start)
+
+
+async def store_metadata_digest(storage: TokenStorage, user_id: str, digest: bytes) -> None:
+    with span("storage.store_metadata_digest"):
+        start = time.perf_counter()
+        try:
+            await storage.store_metadata_digest(user_id, digest)
+        finally:
+            _STORE_DIGEST_TIME.observe(time.perf_counter() - start)
@@ -1,29 +1,135 @@
 from __future__ import annotations
 
 import datetime
+import time
+from typing import Literal
 
 import msgspec
 
 
-class _DiscordConfig(msgspec.Struct):
+class ConnectionPoolConfig(msgspec.Struct):
+    """Connection pool and timeout settings for the HTTP session used to talk to one upstream. Times are in seconds."""
+
+    # Connections open at once, in total and to a single host.
+    limit: int = 100
+    limit_per_host: int = 100
+    # How long an idle connection is kept open for reuse.
+    keepalive_timeout: float = 30
+    # How long resolved DNS entries are cached.
+    dns_cache_ttl: int = 300
+    # Waiting for a free connection from the pool plus establishing it, if a new one is needed.
+    pool_timeout: float = 10
+    # Establishing a new connection.
+    connect_timeout: float = 5
+    # Waiting for the next chunk of the response.
+    read_timeout: float = 30
+    # The whole request, including reading the response.
+    total_timeout: float | None = 60
+    # Stop sending requests for breaker_open_for seconds once breaker_failure_rate of the requests over the last
+    # breaker_window seconds failed, counting only windows with at least breaker_min_requests requests.
+    breaker_enabled: bool = True
+    breaker_window: float = 30
+    breaker_min_requests: int = 20
+    breaker_failure_rate: float = 0.5
+    breaker_open_for: float = 30
+    # Send a second copy of idempotent GETs that haven't been answered after this long. Off when unset.
+    hedge_after: float | None = None
+
+
+class DiscordConfig(msgspec.Struct):
     token: str
     client_id: str
     client_secret: str
     redirect_uri: str
+    api_base: str = "https://discord.com/api/v10"
+    http: ConnectionPoolConfig = msgspec.field(default_factory=ConnectionPoolConfig)
+    # The role connection metadata schema to register. Leave unset to use the built-in Patreon schema.
+    metadata_schema: list[SchemaField] | None = None
+    role_connection_cache_size: int = 10_000
+    role_connection_cache_ttl: float = 30
 
 
-class _PatreonConfig(msgspec.Struct):
+class PatreonConfig(msgspec.Struct):
     client_id: str
     client_secret: str
     creator_access_token: str
     creator_refresh_token: str
     redirect_uri: str
+    api_base: str = "https://www.patreon.com/api"
+    http: ConnectionPoolConfig = msgspec.field(default_factory=ConnectionPoolConfig)
+    campaign_id: str = ""
+    webhook_secret: str = ""
+    membership_cache_size: int = 100_000
+    membership_cache_ttl: float = 3600
+
+
+class _StorageConfig(msgspec.Struct):
+    backend: Literal["memory", "sqlite"] = "sqlite"
+    path: str = "tokens.sqlite3"
+    cache_size: int = 10_000
+    cache_ttl: float | None = None
+    # The first key encrypts tokens at rest; the rest only decrypt. Empty leaves tokens unencrypted.
+    encryption_keys: list[bytes] = msgspec.field(default_factory=list)
+    crypto_threads: int = 2
+
+
+class _RefreshConfig(msgspec.Struct):
+    enabled: bool = True
+    lead_time: float = 300
+    jitter: float = 120
+    max_concurrency: int = 8
+
+
+class AdmissionConfig(msgspec.Struct):
+    """Token bucket limits for the OAuth and metadata endpoints. Rates are requests a second."""
+
+    enabled: bool = True
+    ip_rate: float = 2
+    ip_burst: int = 20
+    user_rate: float = 0.2
+    user_burst: int = 5
+    max_entries: int = 100_000
+    sweep_interval: float = 60
+    # Calls to /update-metadata for a user within this many seconds of each other are collapsed into one push.
+    coalesce_window: float = 5
+
+
+class TracingConfig(msgspec.Struct):
+    enabled: bool = True
+    # Traces that fail or take at least slow_threshold seconds are always logged; this fraction of the rest is.
+    sample_rate: float = 0.01
+    slow_threshold: float = 1.0
+    max_spans: int = 200
+
+
+class _ServerConfig(msgspec.Struct):
+    host: str = "0.0.0.0"  # noqa: S104
+    port: int = 80
+    workers: int = 1
+
+
+class _JobsConfig(msgspec.Struct):
+    path: str = "jobs.sqlite3"
+    workers: int = 8
+    max_attempts: int = 8
+    backoff_base: float = 1
+    backoff_max: float = 300
 
 
 class Config(msgspec.Struct):
     cookie_secret: bytes
-    discord: _DiscordConfig
-    patreon: _PatreonConfig
+    discord: DiscordConfig
+    patreon: PatreonConfig
+    # Secrets that cookie_secret replaced. OAuth state signed with them is still accepted, so logins in progress
+    # during a rotation complete. They can be dropped once the state max age has passed.
+    previous_cookie_secrets: list[bytes] = msgspec.field(default_factory=list)
+    admin_token: str = ""
+    server: _ServerConfig = msgspec.field(default_factory=_ServerConfig)
+    storage: _StorageConfig = msgspec.field(default_factory=_StorageConfig)
+    refresh: _RefreshConfig = msgspec.field(default_factory=_RefreshConfig)
+    jobs: _JobsConfig = msgspec.field(default_factory=_JobsConfig)
+    admission: AdmissionConfig = msgspec.field(default_factory=AdmissionConfig)
+    tracing: TracingConfig = msgspec.field(default_factory=TracingConfig)
 
 
 class SchemaField(msgspec.Struct):
@@ -33,12 +139,50 @@ class SchemaField(msgspec.Struct):
     type: int
 
 
+class RoleConnection(msgspec.Struct):
+    """A user's role connection to this app, as Discord returns it. Metadata values come back as strings."""
+
+    platform_name: str | None = None
+    platform_username: str | None = None
+    metadata: dict[str, str] = msgspec.field(default_factory=dict)
+
+
 class AccessTokenObject(msgspec.Struct):
+    """An OAuth2 token response. Only ever decoded; everything past the token request works with a TokenRecord."""
+
     access_token: str
     expires_in: int
     refresh_token: str
 
 
+class OAuth2ErrorResponse(msgspec.Struct):
+    """The body of a failed OAuth2 token request."""
+
+    error: str = ""
+
+
+class TokenRecord(msgspec.Struct, array_like=True, gc=False):
+    """A user's tokens as they're kept and stored, with the expiry as an absolute Unix timestamp.
+
+    This is encoded as a plain array rather than a map and is never tracked by the garbage collector, which keeps both
+    the stored rows and the in-process caches small.
+    """
+
+    access_token: str
+    refresh_token: str
+    expires_at: int
+
+    @classmethod
+    def issued(cls, response: AccessTokenObject, now: float | None = None) -> TokenRecord:
+        """Build a record for tokens that were just issued, fixing `expires_in` to a point in time."""
+
+        issued_at = int(time.time() if now is None else now)
+        return cls(response.access_token, response.refresh_token, issued_at + response.expires_in)
+
+    def expires_within(self, seconds: int = 0) -> bool:
+        return self.expires_at <= int(time.time()) + seconds
+
+
 class _ApplicationInfo(msgspec.Struct):
     id: str
     name: str
@@ -67,3 +211,171 @@ class OAuth2UserInfo(msgspec.Struct):
     scopes: list[str]
     expires: datetime.datetime
     user: _UserInfo
+
+
+class PatreonLink(msgspec.Struct):
+    """Which Patreon user (and campaign membership, if any) a Discord user linked."""
+
+    patreon_user_id: str
+    member_id: str | None = None
+
+
+class PushMetadataJob(msgspec.Struct):
+    """A queued push of a user's metadata to Discord."""
+
+    # Push even if the metadata matches what was last pushed.
+    force: bool = False
+
+
+class PatreonMembership(msgspec.Struct, frozen=True):
+    """The parts of a Patreon membership that feed into role connection metadata."""
+
+    patron_status: str | None = None
+    currently_entitled_amount_cents: int = 0
+    pledge_relationship_start: datetime.datetime | None = None
+    tier_ids: tuple[str, ...] = ()
+
+
+# Patreon's v2 API speaks JSON:API. Only the parts this app reads are modelled.
+
+
+class _ResourceRef(msgspec.Struct):
+    id: str
+    type: str
+
+
+class _ToOne(msgspec.Struct):
+    data: _ResourceRef | None = None
+
+
+class _ToMany(msgspec.Struct):
+    data: list[_ResourceRef] = msgspec.field(default_factory=list)
+
+
+class _MemberAttributes(msgspec.Struct):
+    patron_status: str | None = None
+    currently_entitled_amount_cents: int = 0
+    pledge_relationship_start: datetime.datetime | None = None
+
+
+class _MemberRelationships(msgspec.Struct):
+    user: _ToOne = msgspec.field(default_factory=_ToOne)
+    campaign: _ToOne = msgspec.field(default_factory=_ToOne)
+    currently_entitled_tiers: _ToMany = msgspec.field(default_factory=_ToMany)
+
+
+class PatreonMemberResource(msgspec.Struct, tag_field="type", tag="member"):
+    id: str
+    attributes: _MemberAttributes = msgspec.field(default_factory=_MemberAttributes)
+    relationships: _MemberRelationships = msgspec.field(default_factory=_MemberRelationships)
+
+    @property
+    def patreon_user_id(self) -> str | None:
+        user = self.relationships.user.data
+        return user.id if user else None
+
+    def to_membership(self) -> PatreonMembership:
+        return PatreonMembership(
+            patron_status=self.attributes.patron_status,
+            currently_entitled_amount_cents=self.attributes.currently_entitled_amount_cents,
+            pledge_relationship_start=self.attributes.pledge_relationship_start,
+            tier_ids=tuple(tier.id for tier in self.relationships.currently_entitled_tiers.data),
+        )
+
+
+class _CampaignResource(msgspec.Struct, tag_field="type", tag="campaign"):
+    id: str
+
+
+class _TierResource(msgspec.Struct, tag_field="type", tag="tier"):
+    id: str
+
+
+class PatreonMemberDocument(msgspec.Struct):
+    """A single member, as returned by the members endpoint and sent by members:* webhooks."""
+
+    data: PatreonMemberResource
+
+
+class _SocialConnection(msgspec.Struct):
+    user_id: str
+
+
+class _SocialConnections(msgspec.Struct):
+    discord: _SocialConnection | None = None
+
+
+class _PatreonUserAttributes(msgspec.Struct):
+    social_connections: _SocialConnections | None = None
+
+
+class _PatreonUserRelationships(msgspec.Struct):
+    memberships: _ToMany = msgspec.field(default_factory=_ToMany)
+
+
+class _PatreonUserResource(msgspec.Struct, tag_field="type", tag="user"):
+    id: str
+    attributes: _PatreonUserAttributes = msgspec.field(default_factory=_PatreonUserAttributes)
+    relationships: _PatreonUserRelationships = msgspec.field(default_factory=_PatreonUserRelationships)
+
+
+class PatreonIdentity(msgspec.Struct):
+    """The response from Patreon's identity endpoint, with the user's memberships included."""
+
+    data: _PatreonUserResource
+    included: list[PatreonMemberResource | _CampaignResource] = msgspec.field(default_factory=list)
+
+    @property
+    def discord_user_id(self) -> str | None:
+        connections = self.data.attributes.social_connections
+        return connections.discord.user_id if connections and connections.discord else None
+
+    def membership_for(self, campaign_id: str) -> PatreonMemberResource | None:
+        for member in self.included:
+            if not isinstance(member, PatreonMemberResource):
+                continue
+            campaign = member.relationships.campaign.data
+            if not campaign_id or (campaign and campaign.id == campaign_id):
+                return member
+        return None
+
+
+class _Cursors(msgspec.Struct):
+    next: str | None = None
+
+
+class _Pagination(msgspec.Struct):
+    cursors: _Cursors | None = None
+    total: int | None = None
+
+
+class _PageMeta(msgspec.Struct):
+    pagination: _Pagination = msgspec.field(default_factory=_Pagination)
+
+
+class PatreonMembersPage(msgspec.Struct):
+    """One page of a campaign's members, with each member's user and tiers included."""
+
+    data: list[PatreonMemberResource]
+    included: list[_PatreonUserResource | _TierResource] = msgspec.field(default_factory=list)
+    meta: _PageMeta = msgspec.field(default_factory=_PageMeta)
+
+    @property
+    def next_cursor(self) -> str | None:
+        cursors = self.meta.pagination.cursors
+        return cursors.next if cursors else None
+
+    def discord_user_ids(self) -> dict[str, str]:
+        """Map the Patreon user ids on this page to the Discord accounts they connected, where there is one."""
+
+        result: dict[str, str] = {}
+        for resource in self.included:
+            if isinstance(resource, _PatreonUserResource):
+                connections = resource.attributes.social_connections
+                if connections and connections.discord:
+                    result[resource.id] = connections.discord.user_id
+        return result
+
+
+class PatreonCampaigns(msgspec.Struct):
+    data: list[_CampaignResource]
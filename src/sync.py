@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+import msgspec
+
+from .jobs import JobQueue
+from .metadata import PUSH_METADATA, enqueue_push
+from .patreon import PatreonAPI, get_creator_campaign_id, ingest_campaign_members
+from .storage import TokenStorage
+from .structs import PushMetadataJob
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SyncProgress(msgspec.Struct):
+    """The state of a bulk sync. This is also what gets written to the checkpoint file."""
+
+    after: str | None = None
+    queued: int = 0
+    running: bool = False
+    started_at: float = 0.0
+    finished_at: float | None = None
+
+    @property
+    def rate(self) -> float:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return self.queued / elapsed if elapsed > 0 else 0.0
+
+
+def _load_checkpoint(path: Path) -> SyncProgress:
+    try:
+        return msgspec.json.decode(path.read_bytes(), type=SyncProgress)
+    except FileNotFoundError:
+        return SyncProgress()
+
+
+def _save_checkpoint(path: Path, progress: SyncProgress) -> None:
+    # Write then rename, so an interrupted write never leaves a corrupt checkpoint behind.
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(msgspec.json.encode(progress))
+    tmp.replace(path)
+
+
+async def _report_progress(progress: SyncProgress, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        LOGGER.info(
+            "Bulk sync: %d pushes queued, %.1f users/s, last checkpoint %s.",
+            progress.queued,
+            progress.rate,
+            progress.after,
+        )
+
+
+async def bulk_sync(
+    queue: JobQueue,
+    storage: TokenStorage,
+    *,
+    batch_size: int = 1000,
+    checkpoint: Path | None = None,
+    progress: SyncProgress | None = None,
+    report_interval: float = 5.0,
+) -> SyncProgress:
+    """Queue a metadata push for every user in the token store.
+
+    Users are streamed out of storage in batches, in id order, and each batch is queued in one transaction. Once it
+    has been, the last id in it is recorded in the checkpoint file. Resuming with the same checkpoint picks up after
+    that id. The checkpoint is removed when the sync finishes. The pushes themselves are done by the job queue's
+    workers, in this process or any other sharing the queue.
+    """
+
+    if progress is None:
+        progress = _load_checkpoint(checkpoint) if checkpoint else SyncProgress()
+    progress.running = True
+    progress.started_at = time.time()
+    progress.finished_at = None
+
+    reporter = asyncio.create_task(_report_progress(progress, report_interval))
+    batches: AsyncIterator[list[str]] = storage.iter_user_ids(progress.after, batch_size)
+    try:
+        async for batch in batches:
+            await queue.enqueue_many(PUSH_METADATA, [(user_id, PushMetadataJob()) for user_id in batch])
+            progress.queued += len(batch)
+            progress.after = batch[-1]
+            if checkpoint:
+                _save_checkpoint(checkpoint, progress)
+    finally:
+        await _finish(reporter, progress)
+
+    if checkpoint:
+        checkpoint.unlink(missing_ok=True)
+    return progress
+
+
+async def sync_campaign(
+    queue: JobQueue,
+    patreon: PatreonAPI,
+    *,
+    progress: SyncProgress | None = None,
+    report_interval: float = 5.0,
+) -> SyncProgress:
+    """Ingest the creator's campaign members from Patreon and queue pushes for linked users whose membership changed.
+
+    Pushes are queued as soon as the first page of members has been ingested, while later pages are still being
+    fetched.
+    """
+
+    progress = progress or SyncProgress()
+    progress.running = True
+    progress.started_at = time.time()
+
+    reporter = asyncio.create_task(_report_progress(progress, report_interval))
+    try:
+        campaign_id = await get_creator_campaign_id(patreon)
+        async for user_id in ingest_campaign_members(patreon, campaign_id):
+            await enqueue_push(queue, user_id)
+            progress.queued += 1
+    finally:
+        await _finish(reporter, progress)
+    return progress
+
+
+async def _finish(reporter: asyncio.Task[None], progress: SyncProgress) -> None:
+    progress.running = False
+    progress.finished_at = time.time()
+    reporter.cancel()
+    await asyncio.gather(reporter, return_exceptions=True)
+    LOGGER.info(
+        "Bulk sync finished: %d pushes queued in %.1fs.",
+        progress.queued,
+        progress.finished_at - progress.started_at,
+    )
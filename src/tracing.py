@@ -0,0 +1,192 @@
+"""Lightweight request tracing.
+
+Each request (and each background job) runs inside a trace, carried in a context variable so that everything it calls,
+including tasks it starts, can add spans without the trace being passed around. A span is just a name, timings and a
+few attributes. When the trace finishes it's logged as one JSON line if it's worth keeping: every failed or slow trace
+is kept, and only a sample of the rest. Outside a trace, spans cost almost nothing.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import random
+import time
+from collections.abc import Awaitable, Callable
+from contextvars import ContextVar, Token
+from types import TracebackType
+
+import msgspec
+from aiohttp import web
+from aiohttp.typedefs import Middleware
+
+from .structs import TracingConfig
+
+
+LOGGER = logging.getLogger(__name__)
+
+AttrValue = str | int | float | bool
+
+
+class Span(msgspec.Struct, omit_defaults=True):
+    name: str
+    # Milliseconds since the start of the trace.
+    start_ms: float
+    duration_ms: float
+    error: str | None = None
+    attrs: dict[str, AttrValue] | None = None
+
+
+class TraceRecord(msgspec.Struct, omit_defaults=True):
+    """A finished trace, as it's logged."""
+
+    trace_id: str
+    name: str
+    duration_ms: float
+    spans: list[Span]
+    status: int | None = None
+    error: str | None = None
+    attrs: dict[str, AttrValue] | None = None
+    dropped_spans: int = 0
+
+
+class Trace:
+    __slots__ = ("trace_id", "name", "config", "attrs", "start", "spans", "dropped_spans", "status", "error")
+
+    def __init__(self, name: str, config: TracingConfig, attrs: dict[str, AttrValue]) -> None:
+        self.trace_id = os.urandom(8).hex()
+        self.config = config
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.spans: list[Span] = []
+        self.dropped_spans = 0
+        self.status: int | None = None
+        self.error: str | None = None
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+def current_trace_id() -> str | None:
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+class span:
+    """Time a block as a span of the current trace, if there is one. Attributes can be added while it runs."""
+
+    __slots__ = ("name", "attrs", "_trace", "_start")
+
+    def __init__(self, name: str, **attrs: AttrValue) -> None:
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> span:
+        self._trace = _current_trace.get()
+        self._start = time.perf_counter()
+        return self
+
+    def set(self, key: str, value: AttrValue) -> None:
+        self.attrs[key] = value
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        trace = self._trace
+        if trace is None:
+            return
+        if len(trace.spans) >= trace.config.max_spans:
+            trace.dropped_spans += 1
+            return
+        end = time.perf_counter()
+        trace.spans.append(
+            Span(
+                self.name,
+                round((self._start - trace.start) * 1000, 3),
+                round((end - self._start) * 1000, 3),
+                exc_type.__name__ if exc_type is not None else None,
+                self.attrs or None,
+            ),
+        )
+
+
+class traced:
+    """Run a block as a new trace, logged when the block exits if it's sampled. Yields None if tracing is off."""
+
+    __slots__ = ("_trace", "_token")
+
+    def __init__(self, name: str, config: TracingConfig, **attrs: AttrValue) -> None:
+        self._trace = Trace(name, config, attrs) if config.enabled else None
+        self._token: Token[Trace | None] | None = None
+
+    def __enter__(self) -> Trace | None:
+        if self._trace is not None:
+            self._token = _current_trace.set(self._trace)
+        return self._trace
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        trace = self._trace
+        if trace is None or self._token is None:
+            return
+        _current_trace.reset(self._token)
+
+        if exc_type is not None and not issubclass(exc_type, web.HTTPException):
+            trace.error = exc_type.__name__
+        elif trace.status is not None and trace.status >= 500:
+            trace.error = f"HTTP {trace.status}"
+        _finish(trace)
+
+
+def _finish(trace: Trace) -> None:
+    duration = time.perf_counter() - trace.start
+    config = trace.config
+    # Tail sampling: the decision is made once the outcome is known, so failures and slow traces are never lost.
+    if trace.error is None and duration < config.slow_threshold and random.random() >= config.sample_rate:
+        return
+
+    record = TraceRecord(
+        trace.trace_id,
+        trace.name,
+        round(duration * 1000, 3),
+        trace.spans,
+        trace.status,
+        trace.error,
+        trace.attrs or None,
+        trace.dropped_spans,
+    )
+    LOGGER.info("%s took %.1fms", trace.name, record.duration_ms, extra={"trace": record, "trace_id": trace.trace_id})
+
+
+def make_tracing_middleware(config: TracingConfig) -> Middleware:
+    @web.middleware
+    async def tracing_middleware(
+        request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+    ) -> web.StreamResponse:
+        resource = request.match_info.route.resource
+        name = f"{request.method} {resource.canonical if resource is not None else 'unmatched'}"
+        with traced(name, config) as trace:
+            if trace is None:
+                return await handler(request)
+            try:
+                response = await handler(request)
+            except web.HTTPException as err:
+                trace.status = err.status
+                err.headers["X-Trace-Id"] = trace.trace_id
+                raise
+            except Exception:
+                trace.status = 500
+                raise
+            trace.status = response.status
+            response.headers["X-Trace-Id"] = trace.trace_id
+            return response
+
+    return tracing_middleware
@@ -1,41 +1,75 @@
 from __future__ import annotations
 
 import base64
-import datetime
+import binascii
+import hashlib
+import hmac
 import os
-from typing import Any
+import struct
+import time
+from collections.abc import Sequence
 
-import msgspec
-from cryptography import fernet
 
-from .config import CONFIG
-from .structs import AccessTokenObject
+# OAuth state tokens: version (1 byte) | key id (1) | issued at, unix seconds (4) | nonce (16) | HMAC-SHA256 tag,
+# truncated (16). The whole thing is base64url encoded once, without padding.
+STATE_VERSION = 1
+STATE_MAX_AGE = 600
+_STATE_HEADER = struct.Struct(">BBI")
+_NONCE_SIZE = 16
+_TAG_SIZE = 16
+_STATE_SIZE = _STATE_HEADER.size + _NONCE_SIZE + _TAG_SIZE
+_ENCODED_STATE_SIZE = len(base64.urlsafe_b64encode(bytes(_STATE_SIZE)).rstrip(b"="))
+# Tolerate issue times slightly in the future, for workers whose clocks disagree a little.
+_CLOCK_SKEW = 60
 
 
-SECRET_KEY = base64.urlsafe_b64encode(CONFIG.cookie_secret)
-FERNET_CRYPT = fernet.Fernet(SECRET_KEY)
+def _derive_key(secret: bytes) -> tuple[int, bytes]:
+    # Don't use the configured secret directly, since it may be used for other things too.
+    key = hashlib.blake2b(secret, digest_size=32, person=b"oauth-state").digest()
+    return key[0], key
+
+
+def derive_state_keys(secrets: Sequence[bytes]) -> list[tuple[int, bytes]]:
+    """Derive the state keys. The first secret signs; all of them verify, so logins started before a rotation finish."""
+
+    return [_derive_key(secret) for secret in secrets]
 
 
 def random_nonce(bytes_size: int = 16) -> bytes:
     return base64.urlsafe_b64encode(os.urandom(bytes_size))
 
 
-def sign(payload: AccessTokenObject, expires: int = 300000) -> bytes:
-    payload_dict = msgspec.convert(payload, type=dict[str, Any])
-    payload_dict["expires_at"] = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires)
-    data = msgspec.json.encode(payload_dict)
-    signature = FERNET_CRYPT.encrypt(data)
-    return base64.urlsafe_b64encode(data) + b"." + base64.urlsafe_b64encode(signature)
+def make_state(keys: Sequence[tuple[int, bytes]]) -> str:
+    """Create a fresh OAuth state token: a random nonce, signed and timestamped with the first of `keys`."""
+
+    key_id, key = keys[0]
+    payload = _STATE_HEADER.pack(STATE_VERSION, key_id, int(time.time())) + os.urandom(_NONCE_SIZE)
+    tag = hmac.digest(key, payload, "sha256")[:_TAG_SIZE]
+    return base64.urlsafe_b64encode(payload + tag).rstrip(b"=").decode()
+
+
+def verify_state(token: str, keys: Sequence[tuple[int, bytes]], *, max_age: float = STATE_MAX_AGE) -> bool:
+    """Check that a state token was made by `make_state` with one of `keys` and hasn't expired."""
 
+    if len(token) != _ENCODED_STATE_SIZE:
+        return False
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return False
 
-def verify(token: bytes) -> AccessTokenObject | None:
-    data, _, signature = token.partition(b".")
-    if not signature:
-        return None
+    payload, tag = raw[:-_TAG_SIZE], raw[-_TAG_SIZE:]
+    version, key_id, issued_at = _STATE_HEADER.unpack_from(payload)
+    if version != STATE_VERSION:
+        return False
 
-    payload_dict: dict[str, Any] = msgspec.json.decode(base64.urlsafe_b64decode(data))
-    if payload_dict["expires_at"] < datetime.datetime.now(datetime.timezone.utc):
-        return None
+    age = time.time() - issued_at
+    if not -_CLOCK_SKEW <= age <= max_age:
+        return False
 
-    is_valid = FERNET_CRYPT.decrypt(base64.urlsafe_b64encode(signature)) == base64.urlsafe_b64decode(data)
-    return msgspec.convert(payload_dict, AccessTokenObject) if is_valid else None
+    # Key ids are a single byte of the key, so two keys could share one; try each match.
+    return any(
+        hmac.compare_digest(hmac.digest(key, payload, "sha256")[:_TAG_SIZE], tag)
+        for candidate_id, key in keys
+        if candidate_id == key_id
+    )